@@ -1,120 +1,1234 @@
-import random
+import os
+import copy
+import json
+import time
+import heapq
+from functools import reduce
 import numpy as np
-from scipy.stats import entropy as shannon_entropy
 
-class OverlappingWFC:
-    def __init__(self, width, height, catalog, weights, adjacency):
+# Try because when you run this file directly, you cant use . since it is not a package.
+try:
+    from .helper import AdjacencyRules, center_tiles
+    from .numba_backend import njit, compat_classes, propagate_bitset
+except ImportError:
+    from helper import AdjacencyRules, center_tiles
+    from numba_backend import njit, compat_classes, propagate_bitset
+
+# Offsets of the 4 cardinal directions (0=up, 1=right, 2=down, 3=left)
+DIRECTIONS = [(0, -1), (1, 0), (0, 1), (-1, 0)]
+
+
+def pack_patterns(mask):
+    """
+    Pack a boolean array along its last axis into uint64 words,
+    where bit i of word k stands for pattern 64 * k + i.
+    """
+    packed = np.packbits(mask, axis=-1, bitorder='little')
+    padded = np.zeros(packed.shape[:-1] + (-(-packed.shape[-1] // 8) * 8,), dtype=np.uint8)
+    padded[..., :packed.shape[-1]] = packed
+    return padded.view(np.uint64)
+
+
+def unpack_patterns(words, num_patterns):
+    """
+    Unpack uint64 words produced by pack_patterns back into a boolean array of num_patterns flags.
+    """
+    bits = np.unpackbits(np.ascontiguousarray(words).view(np.uint8), axis=-1, bitorder='little')
+    return bits[..., :num_patterns].astype(bool)
+
+
+def pack_adjacency(adjacency):
+    """
+    Pack the rules into (4, P, words) uint64 rows straight from the CSR arrays, without a dense
+    (P, P) matrix: bit j of compat[d][i] is set if pattern j may sit in direction d of pattern i.
+    """
+    num_patterns = adjacency.num_patterns
+    words = -(-num_patterns // 64)
+    compat = np.zeros((4, num_patterns * words), dtype=np.uint64)
+    for direction in range(4):
+        indices = adjacency.indices[direction]
+        rows = np.repeat(np.arange(num_patterns), np.diff(adjacency.indptr[direction]))
+        bits = np.left_shift(np.uint64(1), (indices % 64).astype(np.uint64))
+        np.bitwise_or.at(compat[direction], rows * words + indices // 64, bits)
+    return compat.reshape(4, num_patterns, words)
+
+
+def bitset_tables(adjacency, backend="numpy"):
+    """
+    Build the lookup tables of BitsetWFC once, so solvers sharing the rules can share them too:
+    the packed compatibility rows and, for the Numba backend, their classes (see compat_classes).
+    """
+    tables = {'compat': pack_adjacency(adjacency)}
+    if backend == "numba" and njit is not None:
+        tables['class_of'], tables['class_rows'] = compat_classes(tables['compat'])
+    return tables
+
+
+def initial_support(adjacency, width, height, num_patterns):
+    """
+    Build the AC-4 support counters: support[y, x, d, j] counts the patterns of the cell
+    opposite to direction d that allow pattern j at (x, y). Initially every pattern is possible.
+    """
+    counts = np.stack([np.bincount(indices, minlength=num_patterns) for indices in adjacency.indices])
+    dtype = np.int16 if counts.max() < np.iinfo(np.int16).max else np.int32
+    return np.tile(counts.astype(dtype), (height, width, 1, 1))
+
+
+class SolverStats:
+    def __init__(self):
         """
-        Initialize the WFC grid, patterns, weights, and adjacency rules.
+        Opt-in counters and timings of a solver run, created by WFCSolver.enable_stats().
+        Times are in seconds and summed over all steps.
+        """
+        self.observations = 0 # Cells taken from the entropy queue
+        self.collapses = 0 # Cells collapsed to a single pattern
+        self.propagations = 0 # Propagation runs
+        self.cells_visited = 0 # Cells popped from the propagation stack (or AC-4 removal list)
+        self.removals = 0 # Patterns removed from cells
+        self.queue_pushes = 0 # Entropy queue pushes
+        self.peak_queue_length = 0 # Longest the entropy queue has been
+        self.contradictions = 0 # Cells that ran out of patterns
+        self.observe_time = 0.0
+        self.collapse_time = 0.0
+        self.propagate_time = 0.0
+
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class EntropyQueue:
+    def __init__(self, width, height, weights, noise, stats=None):
+        """
+        Track the running sums (sum of w and sum of w * log w) of every cell's remaining
+        patterns together with a min-heap of cell entropies, so the next cell to collapse
+        can be found without scanning the grid.
+        """
+        weights = np.asarray(weights, dtype=float)
+        self.weight_log_weight = weights * np.log2(weights)
+        self.noise = noise # Fixed tiny per-cell noise for tie-breaking
+
+        # Running sums and pattern counts of every cell, updated whenever patterns are removed
+        self.counts = np.full((height, width), len(weights), dtype=np.int64)
+        self.sum_w = np.full((height, width), weights.sum())
+        self.sum_w_log_w = np.full((height, width), self.weight_log_weight.sum())
+
+        # Current entropy of every cell; heap entries that no longer match it are stale
+        self.entropies = self.compute_entropy(self.sum_w, self.sum_w_log_w) + noise
+        self.heap = [(self.entropies[y, x], x, y) for y in range(height) for x in range(width)]
+        heapq.heapify(self.heap)
+
+        # Optional SolverStats receiving push counts and the peak queue length
+        self.stats = stats
+        if stats is not None:
+            stats.peak_queue_length = max(stats.peak_queue_length, len(self.heap))
+
+
+    def copy(self):
+        """
+        Return an independent copy of the queue's mutable state; the weights and noise are shared.
+        """
+        queue = copy.copy(self)
+        queue.counts = self.counts.copy()
+        queue.sum_w = self.sum_w.copy()
+        queue.sum_w_log_w = self.sum_w_log_w.copy()
+        queue.entropies = self.entropies.copy()
+        queue.heap = list(self.heap)
+        queue.stats = None
+        return queue
+
+
+    @staticmethod
+    def compute_entropy(sum_w, sum_w_log_w):
+        """
+        Shannon entropy (in bits) of a weighted pattern set given its running sums.
+        """
+        return np.log2(sum_w) - sum_w_log_w / sum_w
+
+
+    def remove(self, x, y, count, sum_w, sum_w_log_w):
+        """
+        Subtract the sums of patterns removed from cell (x, y) and queue its new entropy.
+        """
+        self.counts[y, x] -= count
+        self.sum_w[y, x] -= sum_w
+        self.sum_w_log_w[y, x] -= sum_w_log_w
+
+        if self.counts[y, x] > 1:
+            entropy = self.compute_entropy(self.sum_w[y, x], self.sum_w_log_w[y, x]) + self.noise[y, x]
+            self.entropies[y, x] = entropy
+            heapq.heappush(self.heap, (entropy, x, y))
+
+            if self.stats is not None:
+                self.stats.queue_pushes += 1
+                self.stats.peak_queue_length = max(self.stats.peak_queue_length, len(self.heap))
+
+
+    def restore(self, x, y, count, sum_w, sum_w_log_w):
+        """
+        Add back the sums of patterns restored to cell (x, y) and queue its new entropy.
+        """
+        self.remove(x, y, -count, -sum_w, -sum_w_log_w)
+
+
+    def pop(self):
+        """
+        Return the uncollapsed cell with minimal entropy, or None if every cell is decided.
+        """
+        while self.heap:
+            entropy, x, y = heapq.heappop(self.heap)
+
+            # Skip stale entries and cells that are already down to one (or zero) patterns
+            if self.counts[y, x] > 1 and entropy == self.entropies[y, x]:
+                return x, y
+
+        return None
+
+
+    def pop_distant(self, count, distance):
+        """
+        Pop up to count uncollapsed cells in order of entropy, skipping cells closer than distance
+        (Chebyshev) to one already taken. Skipped cells are queued again; the search gives up
+        after skipping 4 * count cells so a crowded end of the run stays cheap.
+        """
+        cells = []
+        skipped = []
+        while len(cells) < count and len(skipped) < 4 * count:
+            cell = self.pop()
+            if cell is None:
+                break
+            x, y = cell
+            if all(max(abs(x - cx), abs(y - cy)) >= distance for cx, cy in cells):
+                cells.append(cell)
+            else:
+                skipped.append(cell)
+
+        for x, y in skipped:
+            heapq.heappush(self.heap, (self.entropies[y, x], x, y))
+        return cells
+
+
+class WFCSolver:
+    def __init__(self, width, height, catalog, weights, adjacency, propagator="ac3", seed=None,
+                 max_backtracks=0, max_restarts=0, fixed=None, observations=1, observation_distance=8):
+        """
+        Shared solver loop of the WFC engines: entropy-ordered observation, constraint propagation
+        (AC-3 or AC-4) and recovery from contradictions by backtracking or restarting.
+        fixed optionally maps cells (x, y) to the pattern indices allowed there; these
+        constraints are applied and propagated at the start of every attempt.
+        With observations > 1, every step collapses up to that many lowest-entropy cells that are
+        at least observation_distance apart and propagates once from all of them. Each cell is
+        its own decision, but a choice is never banned for a contradiction it may only have caused
+        in combination: the first contradiction undoes the attempt back to its first multi-cell
+        step and redoes that with its first cell only (see retry_first_decision), after which
+        one cell is observed per step.
+        Subclasses store the wave and implement reset_wave, copy_wave, wave_state, load_wave_state,
+        domain, remove_patterns, restore_patterns, restrict_neighbor and render, then call reset().
         """
         self.width = width
         self.height = height
         self.catalog = catalog # List of all unique patterns
-        self.weights = weights # Frequency/probability of each pattern
-        self.adjacency = adjacency # Directional adjacency rules for patterns
+        self.weights = np.asarray(weights, dtype=float) # Frequency/probability of each pattern
         self.pattern_size = len(catalog[0]) # Size of a single pattern (assumed square)
+        self.num_patterns = len(catalog)
+
+        # Directional adjacency rules for patterns, converted to CSR if given as legacy sets
+        if not isinstance(adjacency, AdjacencyRules):
+            adjacency = AdjacencyRules.from_sets(adjacency, self.num_patterns)
+        self.adjacency = adjacency
+        self.rng = np.random.default_rng(seed)
+
+        # Center tile of every pattern, used to render collapsed cells with a single lookup
+        self.center_tiles = center_tiles(catalog)
+
+        # The propagator is either 'ac3' (recompute neighbor domains) or 'ac4' (support counters)
+        if propagator not in ("ac3", "ac4"):
+            raise ValueError(f"Unknown propagator: {propagator}")
+        self.propagator = propagator
+
+        # Contradiction recovery budgets (backtracks are counted per attempt) and usage counters
+        self.max_backtracks = max_backtracks
+        self.max_restarts = max_restarts
+        self.backtracks = 0
+        self.restarts = 0
+        self.failed = False
+
+        # Cells restricted to given patterns before the first observation
+        self.fixed = fixed or {}
+
+        # Cells collapsed per step and their minimal distance
+        self.observations = observations
+        self.observation_distance = observation_distance
+
+        # Cells observed per step from now on, dropped to 1 for good once a multi-cell step conflicts
+        self.step_observations = observations
 
-        # The wave is a grid of sets, each set contains indices of possible patterns
-        self.wave = [[set(range(len(catalog))) for _ in range(width)] for _ in range(height)]
+        # Opt-in instrumentation: SolverStats (see enable_stats) and callbacks, all disabled when None.
+        # on_collapse(solver, x, y, pattern), on_propagate(solver, x, y) and on_contradiction(solver, x, y)
+        self.stats = None
+        self.on_collapse = None
+        self.on_propagate = None
+        self.on_contradiction = None
 
-        # Grid to cache entropy values (optional, not used yet)
-        self.entropies = [[None for _ in range(width)] for _ in range(height)]
+
+    def enable_stats(self):
+        """
+        Start collecting SolverStats for this solver and return them.
+        """
+        self.stats = SolverStats()
+        self.entropy_queue.stats = self.stats
+        self.stats.peak_queue_length = len(self.entropy_queue.heap)
+        return self.stats
+
+
+    def reset(self):
+        """
+        Start a fresh attempt with every pattern allowed in every cell.
+        """
+        self.reset_wave()
 
         # Boolean grid to mark cells that have been collapsed to one pattern
-        self.collapsed = [[False for _ in range(width)] for _ in range(height)]
+        self.collapsed = np.zeros((self.height, self.width), dtype=bool)
 
+        # Priority queue of cell entropies, updated incrementally during propagation
+        noise = self.rng.random((self.height, self.width)) * 1e-6
+        self.entropy_queue = EntropyQueue(self.width, self.height, self.weights, noise, self.stats)
 
-    def run_step(self):
+        # Support counters and pending removals for the AC-4 propagator
+        if self.propagator == "ac4":
+            self.support = initial_support(self.adjacency, self.width, self.height, self.num_patterns)
+            self.removals = []
+
+        # Journal of removals since the first decision, and the trail length at every decision
+        self.trail = []
+        self.decisions = []
+        self.attempt_backtracks = 0
+        self.contradiction = False
+
+        # Cells whose domain changed since the last delta reported by iter_steps; a fresh wave changes them all
+        self.changed_cells = {(x, y) for y in range(self.height) for x in range(self.width)}
+
+        # Fixed cells and patterns without supporters are restricted before the first observation
+        self.apply_fixed()
+
+
+    def unsupported_patterns(self):
         """
-        Perform one collapse step by selecting the cell with minimal entropy and propagating constraints.
+        Return {(x, y): patterns} for the cells where some patterns have no supporter at all in an
+        in-bounds neighbor. Such patterns can never be placed there, but AC-4 only removes patterns
+        whose counters drop to zero, so they are banned before the first observation.
         """
-        min_entropy = float('inf')
-        min_pos = None
-    	
-        # Loop over each cell to find the one with lowest entropy
+        zero = [np.flatnonzero(np.bincount(indices, minlength=self.num_patterns) == 0)
+                for indices in self.adjacency.indices]
+        if not any(len(patterns) for patterns in zero):
+            return {}
+
+        # Cells with the same in-bounds neighbors share one array. Direction d counts the supporters
+        # in the neighbor opposite to it
+        by_sides = {}
+        unsupported = {}
         for y in range(self.height):
             for x in range(self.width):
-                if not self.collapsed[y][x] and len(self.wave[y][x]) > 1:
-                    # Extract weights of possible patterns
-                    choices = list(self.wave[y][x])
-                    weights = np.array([self.weights[i] for i in choices], dtype=float)
+                sides = tuple(0 <= x - dx < self.width and 0 <= y - dy < self.height for dx, dy in DIRECTIONS)
+                if sides not in by_sides:
+                    by_sides[sides] = reduce(np.union1d, [patterns for patterns, side in zip(zero, sides) if side],
+                                             np.zeros(0, dtype=np.int64))
+                if len(by_sides[sides]):
+                    unsupported[(x, y)] = by_sides[sides]
+        return unsupported
+
 
-                    # Normalize to probabilities
-                    probs = weights / weights.sum()
+    def apply_fixed(self):
+        """
+        Restrict the fixed cells to their allowed patterns, ban the unsupported patterns of every cell
+        (see unsupported_patterns) and propagate from all of them at once.
+        A contradiction here cannot be undone by backtracking, so the solver fails immediately.
+        """
+        unsupported = self.unsupported_patterns()
+        cells = list(self.fixed) + [cell for cell in unsupported if cell not in self.fixed]
+        if not cells:
+            return
+
+        # Every domain is still full here, so cells sharing an allowed array and unsupported
+        # patterns share their removal too
+        removals = {}
+        no_patterns = np.zeros(0, dtype=np.int64)
+        for x, y in cells:
+            allowed = self.fixed.get((x, y))
+            banned = unsupported.get((x, y), no_patterns)
+            key = (id(allowed), id(banned))
+            if key not in removals:
+                removals[key] = banned if allowed is None else \
+                    np.union1d(np.setdiff1d(np.arange(self.num_patterns), allowed), banned)
+            self.ban(x, y, removals[key])
+            if allowed is not None and len(allowed) == 1:
+                self.collapsed[y, x] = True
 
-                    # Shannon entropy (in bits)
-                    entropy = shannon_entropy(probs, base=2)
+        self.propagate_cells(cells)
+        if self.contradiction:
+            self.failed = True
 
-                    # Add tiny noise for tie-breaking
-                    entropy += random.random() * 1e-6
 
-                    # Track cell with the minimum entropy
-                    if entropy < min_entropy:
-                        min_entropy = entropy
-                        min_pos = (x, y)
+    def run_step(self):
+        """
+        Perform one collapse step by selecting the cell with minimal entropy and propagating constraints.
+        Returns False once the wave is fully collapsed or a contradiction could not be recovered.
+        """
+        if self.failed:
+            return False
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+
+        # Take the cell with the lowest entropy from the queue, or several distant ones
+        if self.step_observations > 1:
+            cells = self.entropy_queue.pop_distant(self.step_observations, self.observation_distance)
+        else:
+            cell = self.entropy_queue.pop()
+            cells = [] if cell is None else [cell]
 
         # If no uncollapsed cells remain, WFC is complete
-        if min_pos is None:
+        if not cells:
             return False
 
-        # Collapse the chosen cell to a single pattern
-        x, y = min_pos
-        choices = list(self.wave[y][x])
-        weights = [self.weights[i] for i in choices]
-        chosen = random.choices(choices, weights=weights)[0]
+        if stats is not None:
+            stats.observations += len(cells)
+            observed = time.perf_counter()
+            stats.observe_time += observed - start
+
+        # Every collapsed cell gets its own decision, journaled in order together with
+        # the index of the step's first decision
+        first_decision = len(self.decisions)
+        for x, y in cells:
+            # Collapse the chosen cell to a single pattern
+            choices = self.domain(x, y)
+            probs = self.weights[choices] / self.weights[choices].sum()
+            chosen = self.rng.choice(choices, p=probs)
+
+            # Remember the decision point so it can be undone on a contradiction
+            if self.max_backtracks > 0:
+                self.decisions.append((len(self.trail), x, y, chosen, first_decision))
 
-        # Update wave and mark as collapsed
-        self.wave[y][x] = {chosen}
-        self.collapsed[y][x] = True
+            # Update wave and mark as collapsed
+            self.ban(x, y, choices[choices != chosen])
+            self.collapsed[y, x] = True
+
+            if stats is not None:
+                stats.collapses += 1
+            if self.on_collapse is not None:
+                self.on_collapse(self, x, y, chosen)
+
+        if stats is not None:
+            collapsed = time.perf_counter()
+            stats.collapse_time += collapsed - observed
 
         # Propagate constraints to neighbors
-        self.propagate(x, y)
+        self.propagate_cells(cells)
 
+        if stats is not None:
+            stats.propagations += 1
+            stats.propagate_time += time.perf_counter() - collapsed
+        if self.on_propagate is not None:
+            for x, y in cells:
+                self.on_propagate(self, x, y)
+
+        if self.contradiction:
+            return self.recover()
         return True
 
 
+    def retry_first_decision(self, first_decision):
+        """
+        Undo the decisions from a multi-cell step on and redo that step with only its first cell,
+        putting the other cells back in the queue. The choices may only conflict in combination, so
+        none of them is banned here; if the first choice fails on its own, recover() bans it.
+        Choices made without seeing each other conflict, so from here on one cell is observed per step.
+        """
+        self.step_observations = 1
+        trail_length, x, y, chosen, _ = self.decisions[first_decision]
+        for _, other_x, other_y, _, _ in self.decisions[first_decision:]:
+            self.collapsed[other_y, other_x] = False
+        del self.decisions[first_decision:]
+        self.undo(trail_length)
+
+        self.decisions.append((len(self.trail), x, y, chosen, first_decision))
+        domain = self.domain(x, y)
+        self.ban(x, y, domain[domain != chosen])
+        self.collapsed[y, x] = True
+        self.propagate(x, y)
+
+
     def propagate(self, x, y):
         """
         Propagate constraints from a collapsed cell to its neighbors using adjacency rules.
         """
-        stack = [(x, y)]
+        self.propagate_cells([(x, y)])
+
+
+    def propagate_cells(self, cells):
+        """
+        Propagate constraints from several changed cells to their neighbors.
+        """
+        if self.propagator == "ac4":
+            self.propagate_ac4()
+            return
+
+        stack = list(cells)
 
-        while stack:
+        while stack and not self.contradiction:
             cx, cy = stack.pop()
+            domain = self.domain(cx, cy)
+            if self.stats is not None:
+                self.stats.cells_visited += 1
 
             # Check all 4 cardinal directions
-            for direction, (dx, dy) in enumerate([(0, -1), (1, 0), (0, 1), (-1, 0)]):
+            for direction, (dx, dy) in enumerate(DIRECTIONS):
                 nx, ny = cx + dx, cy + dy
 
                 # Skip out-of-bounds neighbors
                 if 0 <= nx < self.width and 0 <= ny < self.height:
-                    possible = set()
-
-                    # Collect all patterns that are valid in the given direction
-                    for t in self.wave[cy][cx]:
-                        possible.update(self.adjacency[t][direction])
-                    
-                    # Update the neighbor's wave by intersecting with allowed patterns
-                    new_wave = self.wave[ny][nx].intersection(possible)
+                    # Remove the neighbor's patterns that no remaining pattern of this cell allows
+                    removed = self.restrict_neighbor(domain, nx, ny, direction)
 
                     # If the neighbor's possibilities changed, propagate further
-                    if new_wave != self.wave[ny][nx]:
-                        self.wave[ny][nx] = new_wave
+                    if len(removed):
+                        self.ban(nx, ny, removed)
                         stack.append((nx, ny))
 
 
+    def propagate_ac4(self):
+        """
+        Propagate pending removals by decrementing the support counters of neighboring cells
+        and removing every pattern whose count drops to zero.
+        """
+        while self.removals and not self.contradiction:
+            cx, cy, removed = self.removals.pop()
+            if self.stats is not None:
+                self.stats.cells_visited += 1
+            if self.decisions:
+                self.trail.append(("support", cx, cy, removed))
+
+            # Patterns of the cell the counters still count after this removal: its domain and
+            # its removals not yet processed. Only needed when they are fewer than the removed ones
+            kept = None
+            if 2 * len(removed) > self.num_patterns:
+                pending = [patterns for px, py, patterns in self.removals if px == cx and py == cy]
+                kept = np.concatenate([self.domain(cx, cy)] + pending)
+
+            for nx, ny, direction, touched, lost in self.support_changes(cx, cy, removed, kept):
+                support = self.support[ny, nx, direction]
+                support[touched] -= lost
+
+                # Patterns that just lost their last supporter are removed from the neighbor
+                unsupported = touched[support[touched] <= 0]
+                if len(unsupported):
+                    self.ban(nx, ny, np.intersect1d(unsupported, self.domain(nx, ny), assume_unique=True))
+
+
+    def support_changes(self, x, y, removed, kept=None):
+        """
+        Yield, for every in-bounds neighbor of (x, y), the patterns of the neighbor that lose
+        supporters when the given patterns are removed from (x, y) and how many each loses.
+        Only the touched patterns are listed, so small removals cost in proportion to their rules, not to P.
+        kept optionally lists the patterns of (x, y) the counters still count after the removal;
+        when these are fewer (e.g. after a collapse), the losses are the counters minus their supports.
+        """
+        for direction, (dx, dy) in enumerate(DIRECTIONS):
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < self.width and 0 <= ny < self.height:
+                if kept is not None and len(kept) < len(removed):
+                    lost = self.support[ny, nx, direction] - np.bincount(self.adjacency.rows(kept, direction),
+                                                                         minlength=self.num_patterns)
+                    touched = np.flatnonzero(lost)
+                    yield nx, ny, direction, touched, lost[touched]
+                    continue
+
+                rows = self.adjacency.rows(removed, direction)
+                if len(rows) < self.num_patterns:
+                    touched, lost = np.unique(rows, return_counts=True)
+                else:
+                    # Counting beats sorting once the rows outnumber the patterns (e.g. a collapse)
+                    lost = np.bincount(rows, minlength=self.num_patterns)
+                    touched = np.flatnonzero(lost)
+                    lost = lost[touched]
+                yield nx, ny, direction, touched, lost
+
+
+    def ban(self, x, y, patterns):
+        """
+        Remove patterns from cell (x, y) and record the removal in the entropy queue,
+        the backtracking trail and the AC-4 pending removals.
+        """
+        if len(patterns) == 0:
+            return
+
+        self.remove_patterns(x, y, patterns)
+        self.record_ban(x, y, patterns)
+
+
+    def record_ban(self, x, y, patterns):
+        """
+        Record patterns already removed from the wave of cell (x, y) in the solver's bookkeeping.
+        """
+        self.entropy_queue.remove(
+            x, y, len(patterns),
+            self.weights[patterns].sum(),
+            self.entropy_queue.weight_log_weight[patterns].sum()
+        )
+
+        self.changed_cells.add((x, y))
+        if self.decisions:
+            self.trail.append(("ban", x, y, patterns))
+        if self.propagator == "ac4":
+            self.removals.append((x, y, patterns))
+        if self.stats is not None:
+            self.stats.removals += len(patterns)
+
+        if self.entropy_queue.counts[y, x] == 0:
+            self.contradiction = True
+            if self.stats is not None:
+                self.stats.contradictions += 1
+            if self.on_contradiction is not None:
+                self.on_contradiction(self, x, y)
+
+
+    def undo(self, trail_length):
+        """
+        Roll the wave, entropy queue and support counters back to an earlier trail length.
+        """
+        while len(self.trail) > trail_length:
+            kind, x, y, patterns = self.trail.pop()
+            if kind == "ban":
+                self.restore_patterns(x, y, patterns)
+                self.changed_cells.add((x, y))
+                self.entropy_queue.restore(
+                    x, y, len(patterns),
+                    self.weights[patterns].sum(),
+                    self.entropy_queue.weight_log_weight[patterns].sum()
+                )
+            else:
+                for nx, ny, direction, touched, lost in self.support_changes(x, y, patterns):
+                    self.support[ny, nx, direction, touched] += lost
+
+        if self.propagator == "ac4":
+            self.removals = []
+        self.contradiction = False
+
+
+    def recover(self):
+        """
+        Resolve a contradiction by undoing the last decision and banning its choice, or
+        by restarting once no decision is left or the backtrack budget is spent.
+        Returns False if the restart budget is exhausted as well.
+        """
+        while self.contradiction:
+            if self.decisions and self.attempt_backtracks < self.max_backtracks:
+                self.backtracks += 1
+                self.attempt_backtracks += 1
+
+                # A choice is only banned once it was made alone. Cells observed together conflict through
+                # the seams between them, which chronological backtracking reaches late, so the attempt is
+                # redone from its first multi-cell step, with that step's first cell only
+                if self.step_observations > 1:
+                    first_decision = next((decision[4] for index, decision in enumerate(self.decisions)
+                                           if decision[4] != index), None)
+                    if first_decision is not None:
+                        self.retry_first_decision(first_decision)
+                        continue
+
+                trail_length, x, y, chosen, _ = self.decisions.pop()
+                self.undo(trail_length)
+                self.collapsed[y, x] = False
+
+                # Ban the failed choice and propagate the reduced domain
+                self.ban(x, y, np.array([chosen]))
+                self.propagate(x, y)
+            elif self.restarts < self.max_restarts:
+                # Seams between cells observed together are a likely cause, so restart observing one at a time
+                self.restarts += 1
+                self.step_observations = 1
+                self.reset()
+            else:
+                self.failed = True
+                return False
+
+        return True
+
+
+    def fork(self, count):
+        """
+        Split the solver into count children that continue independently from its current state,
+        each with its own RNG stream spawned from this solver's. Only the per-run state is copied
+        (for BitsetWFC a few array buffers); the rules and catalog are shared with the parent.
+        Stats and callbacks are not carried over to the children.
+        """
+        return [self.spawn_child(rng) for rng in self.rng.spawn(count)]
+
+
+    def spawn_child(self, rng):
+        """
+        Return a copy of the solver with its own wave, bookkeeping and the given RNG.
+        """
+        child = copy.copy(self)
+        child.rng = rng
+        child.wave = self.copy_wave()
+        child.collapsed = self.collapsed.copy()
+        child.entropy_queue = self.entropy_queue.copy()
+        child.trail = list(self.trail)
+        child.decisions = list(self.decisions)
+        child.changed_cells = set(self.changed_cells)
+        if self.propagator == "ac4":
+            child.support = self.support.copy()
+            child.removals = list(self.removals)
+
+        child.stats = None
+        child.on_collapse = child.on_propagate = child.on_contradiction = None
+        return child
+
+
+    def save_state(self, path, metadata=None):
+        """
+        Write the solver state between two steps to a compressed .npz file: the packed wave,
+        collapsed mask, RNG state, entropy queue, backtracking trail and AC-4 support counters.
+        metadata is an optional JSON-serializable dict of the caller, returned by load_state.
+        The file is written to a temporary name first, so an interrupted save never replaces a good checkpoint.
+        """
+        queue = self.entropy_queue
+        trail = self.trail
+        state = {
+            'shape': np.array([self.width, self.height, self.num_patterns]),
+            'wave': self.wave_state(),
+            'collapsed': self.collapsed,
+            'rng_state': np.array(json.dumps(self.rng.bit_generator.state)),
+            'counters': np.array([self.backtracks, self.restarts, self.attempt_backtracks,
+                                  self.failed, self.contradiction, self.step_observations]),
+            'counts': queue.counts,
+            'sum_w': queue.sum_w,
+            'sum_w_log_w': queue.sum_w_log_w,
+            'entropies': queue.entropies,
+            'noise': queue.noise,
+            'heap': np.array(queue.heap, dtype=float).reshape(-1, 3),
+            'decisions': np.array(self.decisions, dtype=np.int64).reshape(-1, 5),
+            # The trail is flattened into per-entry kinds, cells and lengths plus one array of patterns
+            'trail_kinds': np.array([kind == "support" for kind, _, _, _ in trail], dtype=bool),
+            'trail_cells': np.array([(x, y) for _, x, y, _ in trail], dtype=np.int64).reshape(-1, 2),
+            'trail_lengths': np.array([len(patterns) for _, _, _, patterns in trail], dtype=np.int64),
+            'trail_patterns': np.concatenate([patterns for _, _, _, patterns in trail] or [np.empty(0)]).astype(np.int64),
+            'metadata': np.array(json.dumps(metadata or {})),
+        }
+        if self.propagator == "ac4":
+            state['support'] = self.support
+
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, **state)
+        os.replace(tmp_path, path)
+
+
+    @staticmethod
+    def checkpoint_metadata(path):
+        """
+        Return the metadata dict of a state written by save_state without restoring anything,
+        or None if the file cannot be read.
+        """
+        try:
+            with np.load(path) as state:
+                return json.loads(str(state['metadata']))
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+    def load_state(self, path):
+        """
+        Restore a state written by save_state. The solver must have been created with the same
+        size, rules, propagator and fixed cells; the run then continues exactly as if never interrupted.
+        Returns the metadata dict passed to save_state.
+        """
+        with np.load(path) as state:
+            if tuple(state['shape']) != (self.width, self.height, self.num_patterns):
+                raise ValueError(f"Checkpoint {path} does not match this solver")
+            if (self.propagator == "ac4") != ('support' in state.files):
+                raise ValueError(f"Checkpoint {path} was saved with a different propagator")
+
+            self.load_wave_state(state['wave'])
+            self.collapsed = state['collapsed'].copy()
+            self.rng.bit_generator.state = json.loads(str(state['rng_state']))
+            backtracks, restarts, attempt_backtracks, failed, contradiction, step_observations = state['counters'].tolist()
+            self.backtracks, self.restarts, self.attempt_backtracks = backtracks, restarts, attempt_backtracks
+            self.step_observations = step_observations
+            self.failed, self.contradiction = bool(failed), bool(contradiction)
+
+            queue = EntropyQueue(self.width, self.height, self.weights, state['noise'].copy(), self.stats)
+            queue.counts = state['counts'].copy()
+            queue.sum_w = state['sum_w'].copy()
+            queue.sum_w_log_w = state['sum_w_log_w'].copy()
+            queue.entropies = state['entropies'].copy()
+            queue.heap = [(entropy, int(x), int(y)) for entropy, x, y in state['heap'].tolist()]
+            self.entropy_queue = queue
+
+            self.decisions = [tuple(decision) for decision in state['decisions'].tolist()]
+            bounds = np.cumsum(state['trail_lengths'])
+            patterns = np.split(state['trail_patterns'], bounds[:-1]) if len(bounds) else []
+            self.trail = [("support" if kind else "ban", x, y, removed)
+                          for kind, (x, y), removed in zip(state['trail_kinds'].tolist(), state['trail_cells'].tolist(), patterns)]
+
+            if self.propagator == "ac4":
+                self.support = state['support'].copy()
+                self.removals = []
+            metadata = json.loads(str(state['metadata']))
+
+        # Every cell may differ from what a consumer of iter_steps has seen
+        self.changed_cells = {(x, y) for y in range(self.height) for x in range(self.width)}
+        return metadata
+
+
+    def iter_steps(self):
+        """
+        Run the solver step by step. After every step, yield only the cells whose domain changed,
+        as a list of (x, y, tile, entropy): tile is the center tile of a cell with a single pattern
+        and '?' otherwise, entropy is the cell's current entropy (0 once it is decided).
+        Consumers can apply these deltas to a grid from render() instead of re-rendering every step.
+        """
+        self.changed_cells = set()
+        running = True
+
+        while running:
+            running = self.run_step()
+            yield [self.cell_update(x, y) for x, y in sorted(self.changed_cells)]
+            self.changed_cells = set()
+
+
+    def cell_update(self, x, y):
+        """
+        Return the (x, y, tile, entropy) delta of one cell.
+        """
+        count = self.entropy_queue.counts[y, x]
+        if count > 1:
+            return x, y, '?', float(self.entropy_queue.entropies[y, x])
+        if count == 1:
+            return x, y, str(self.center_tiles[self.domain(x, y)[0]]), 0.0
+        return x, y, '?', 0.0
+
+
+    def collapsed_patterns(self):
+        """
+        Return an (H, W) array holding the pattern of every cell with a single remaining pattern, and -1 elsewhere.
+        """
+        patterns = np.full((self.height, self.width), -1, dtype=np.int64)
+        for y in range(self.height):
+            for x in range(self.width):
+                domain = self.domain(x, y)
+                if len(domain) == 1:
+                    patterns[y, x] = domain[0]
+        return patterns
+
+
+    def best_patterns(self):
+        """
+        Return an (H, W) array holding the highest-weight remaining pattern of every cell, and -1 where none is left.
+        Used as a cheap fallback to resolve cells that are not collapsed yet.
+        """
+        patterns = np.full((self.height, self.width), -1, dtype=np.int64)
+        for y in range(self.height):
+            for x in range(self.width):
+                domain = self.domain(x, y)
+                if len(domain):
+                    patterns[y, x] = domain[np.argmax(self.weights[domain])]
+        return patterns
+
+
+    def render_best(self):
+        """
+        Render the wave with every undecided cell resolved to its highest-weight remaining pattern.
+        The result is not guaranteed to satisfy the adjacency rules where the fallback was used.
+        """
+        patterns = self.best_patterns()
+        return np.where(patterns >= 0, self.center_tiles[patterns], '?').tolist()
+
+
+class OverlappingWFC(WFCSolver):
+    def __init__(self, width, height, catalog, weights, adjacency, propagator="ac3", seed=None,
+                 max_backtracks=0, max_restarts=0, fixed=None, backend="numpy", observations=1, observation_distance=8):
+        """
+        Initialize the WFC grid, patterns, weights, and adjacency rules.
+        The wave is a grid of Python sets of pattern indices; only the NumPy backend is available.
+        """
+        if backend != "numpy":
+            raise ValueError(f"Backend {backend} is only available for BitsetWFC")
+        super().__init__(width, height, catalog, weights, adjacency, propagator, seed,
+                         max_backtracks, max_restarts, fixed, observations, observation_distance)
+        self.reset()
+
+
+    def reset_wave(self):
+        """
+        Fill the wave with sets containing every pattern index.
+        """
+        self.wave = [[set(range(self.num_patterns)) for _ in range(self.width)] for _ in range(self.height)]
+
+
+    def copy_wave(self):
+        return [[set(cell) for cell in row] for row in self.wave]
+
+
+    def wave_state(self):
+        """
+        Return the wave as a packed (H, W, words) bitset, as stored by BitsetWFC.
+        """
+        mask = np.zeros((self.height, self.width, self.num_patterns), dtype=bool)
+        for y in range(self.height):
+            for x in range(self.width):
+                mask[y, x, list(self.wave[y][x])] = True
+        return pack_patterns(mask)
+
+
+    def load_wave_state(self, words):
+        """
+        Rebuild the sets from a packed wave. Removing from full sets keeps the iteration
+        order of the original sets, so sampling continues identically.
+        """
+        removed = ~unpack_patterns(words, self.num_patterns)
+        self.reset_wave()
+        for y in range(self.height):
+            for x in range(self.width):
+                self.wave[y][x].difference_update(np.flatnonzero(removed[y, x]).tolist())
+
+
+    def domain(self, x, y):
+        """
+        Return the sorted indices of the patterns still possible in cell (x, y).
+        Sorting keeps sampling independent of the sets' history of removals and restores.
+        """
+        return np.sort(np.fromiter(self.wave[y][x], dtype=np.int64, count=len(self.wave[y][x])))
+
+
+    def remove_patterns(self, x, y, patterns):
+        self.wave[y][x].difference_update(patterns.tolist())
+
+
+    def restore_patterns(self, x, y, patterns):
+        self.wave[y][x].update(patterns.tolist())
+
+
+    def restrict_neighbor(self, domain, nx, ny, direction):
+        """
+        Return the patterns of cell (nx, ny) not allowed in the given direction by any pattern of domain.
+        """
+        # Mark all patterns that are valid in the given direction
+        possible = self.adjacency.allowed(domain, direction)
+
+        neighbor = self.domain(nx, ny)
+        return neighbor[~possible[neighbor]]
+
+
     def render(self):
         """
         Render the current wave state to a 2D grid by sampling the center tile of each collapsed pattern.
         """
         output = [['?' for _ in range(self.width)] for _ in range(self.height)]
-        center = self.pattern_size // 2
 
         for y in range(self.height):
             for x in range(self.width):
                 if len(self.wave[y][x]) == 1:
-                    # Get the only pattern and extract its center character
-                    pattern = self.catalog[next(iter(self.wave[y][x]))]
-                    output[y][x] = pattern[center][center]
+                    # Get the only pattern and look up its center character
+                    output[y][x] = str(self.center_tiles[next(iter(self.wave[y][x]))])
 
-        return output
\ No newline at end of file
+        return output
+
+
+class BitsetWFC(WFCSolver):
+    def __init__(self, width, height, catalog, weights, adjacency, propagator="ac3", seed=None,
+                 max_backtracks=0, max_restarts=0, fixed=None, backend="numpy", observations=1, observation_distance=8,
+                 tables=None):
+        """
+        Initialize a WFC solver that stores the wave as a packed uint64 (H, W, P / 64) bitset
+        instead of a grid of Python sets. Exposes the same interface as OverlappingWFC.
+        With backend="numba", AC-3 propagation runs as a compiled loop that gives the same
+        result seed for seed; without Numba installed it falls back to NumPy.
+        tables optionally passes the lookup tables built by bitset_tables for the same rules
+        (e.g. views into shared memory), which are then used instead of building private ones.
+        """
+        if backend not in ("numpy", "numba"):
+            raise ValueError(f"Unknown backend: {backend}")
+        if backend == "numba" and njit is None:
+            print("Warning: Numba is not installed, falling back to the NumPy backend")
+            backend = "numpy"
+        self.backend = backend
+
+        super().__init__(width, height, catalog, weights, adjacency, propagator, seed,
+                         max_backtracks, max_restarts, fixed, observations, observation_distance)
+
+        # Packed compatibility rows and their classes for the Numba kernel (see bitset_tables)
+        if tables is None:
+            tables = bitset_tables(self.adjacency, self.backend)
+        self.compat = tables['compat']
+        if self.backend == "numba":
+            if 'class_of' in tables:
+                self.class_of, self.class_rows = tables['class_of'], tables['class_rows']
+            else:
+                self.class_of, self.class_rows = compat_classes(self.compat)
+
+        self.reset()
+
+
+    def reset_wave(self):
+        """
+        Set one bit per (cell, pattern): a bit stays set while the pattern is still possible.
+        """
+        all_patterns = pack_patterns(np.ones(self.num_patterns, dtype=bool))
+        self.wave = np.tile(all_patterns, (self.height, self.width, 1))
+
+
+    def copy_wave(self):
+        return self.wave.copy()
+
+
+    def wave_state(self):
+        return self.wave
+
+
+    def load_wave_state(self, words):
+        self.wave = np.ascontiguousarray(words, dtype=np.uint64).copy()
+
+
+    def domain(self, x, y):
+        """
+        Return the indices of the patterns still possible in cell (x, y).
+        """
+        return np.flatnonzero(unpack_patterns(self.wave[y, x], self.num_patterns))
+
+
+    def pattern_words(self, patterns):
+        """
+        Pack a list of pattern indices into a bitset row.
+        """
+        mask = np.zeros(self.num_patterns, dtype=bool)
+        mask[patterns] = True
+        return pack_patterns(mask)
+
+
+    def remove_patterns(self, x, y, patterns):
+        self.wave[y, x] &= ~self.pattern_words(patterns)
+
+
+    def restore_patterns(self, x, y, patterns):
+        self.wave[y, x] |= self.pattern_words(patterns)
+
+
+    def propagate_cells(self, cells):
+        """
+        Propagate constraints from several changed cells, with the compiled loop if enabled.
+        """
+        if self.backend != "numba" or self.propagator != "ac3":
+            super().propagate_cells(cells)
+            return
+        if self.contradiction:
+            return
+
+        # Contiguous copies, so several start cells reuse the kernel compiled for one
+        starts_x, starts_y = np.array(cells, dtype=np.int64).reshape(-1, 2).T.copy()
+        log_x, log_y, log_words, visited = propagate_bitset(self.wave, self.class_of, self.class_rows, starts_x, starts_y)
+        if self.stats is not None:
+            self.stats.cells_visited += visited
+
+        # Replay the removals in order, so the bookkeeping matches the NumPy backend exactly
+        for x, y, words in zip(log_x.tolist(), log_y.tolist(), log_words):
+            self.record_ban(x, y, np.flatnonzero(unpack_patterns(words, self.num_patterns)))
+
+
+    def restrict_neighbor(self, domain, nx, ny, direction):
+        """
+        Return the patterns of cell (nx, ny) not allowed in the given direction by any pattern of domain.
+        """
+        # Union of the compatibility rows of all remaining patterns
+        possible = np.bitwise_or.reduce(self.compat[direction][domain], axis=0)
+        return np.flatnonzero(unpack_patterns(self.wave[ny, nx] & ~possible, self.num_patterns))
+
+
+    def collapsed_patterns(self):
+        """
+        Return an (H, W) array holding the pattern of every cell with a single remaining pattern, and -1 elsewhere.
+        """
+        wave = unpack_patterns(self.wave, self.num_patterns)
+        return np.where(wave.sum(axis=2) == 1, wave.argmax(axis=2), -1)
+
+
+    def best_patterns(self):
+        """
+        Return an (H, W) array holding the highest-weight remaining pattern of every cell, and -1 where none is left.
+        """
+        wave = unpack_patterns(self.wave, self.num_patterns)
+        best = np.where(wave, self.weights, -1.0).argmax(axis=2)
+        return np.where(wave.any(axis=2), best, -1)
+
+
+    def render(self):
+        """
+        Render the current wave state to a 2D grid by looking up the center tile of each collapsed pattern.
+        """
+        patterns = self.collapsed_patterns()
+        output = np.where(patterns >= 0, self.center_tiles[patterns], '?')
+        return output.tolist()
+
+
+class BatchedWFC:
+    def __init__(self, batch_size, width, height, catalog, weights, adjacency, seed=None, max_restarts=10):
+        """
+        Solve batch_size independent maps at once. The waves are one (B, H, W, P) boolean tensor;
+        every iteration observes one cell in every unfinished map and propagates all maps together,
+        frontier by frontier. A map that hits a contradiction is restarted on its own,
+        up to max_restarts times.
+        """
+        self.batch_size = batch_size
+        self.width = width
+        self.height = height
+        self.catalog = catalog
+        self.num_patterns = len(catalog)
+        self.weights = np.asarray(weights, dtype=float)
+        self.weight_log_weight = self.weights * np.log2(self.weights)
+        self.center_tiles = center_tiles(catalog)
+        self.rng = np.random.default_rng(seed)
+
+        if not isinstance(adjacency, AdjacencyRules):
+            adjacency = AdjacencyRules.from_sets(adjacency, self.num_patterns)
+        self.adjacency = adjacency
+
+        # Patterns with identical compatibility rows form a class (few, since rules follow pattern borders):
+        # membership[i, k] is 1 if pattern i is in class k, and rows[d][k] is the row allowed by class k of
+        # direction d; the columns of direction d's classes in membership are class_slices[d]
+        membership = []
+        self.rows = []
+        self.class_slices = []
+        for direction in range(4):
+            rows, classes = np.unique(adjacency.dense(direction), axis=0, return_inverse=True)
+            start = sum(len(r) for r in self.rows)
+            membership.append(np.eye(len(rows), dtype=np.float32)[classes.ravel()])
+            self.rows.append(rows.astype(np.float32))
+            self.class_slices.append(slice(start, start + len(rows)))
+        self.membership = np.concatenate(membership, axis=1)
+
+        self.max_restarts = max_restarts
+        self.restarts = np.zeros(batch_size, dtype=np.int64)
+        self.failed = np.zeros(batch_size, dtype=bool)
+
+        shape = (batch_size, height, width)
+        self.wave = np.empty(shape + (self.num_patterns,), dtype=bool)
+        self.counts = np.empty(shape, dtype=np.int64)
+        self.sum_w = np.empty(shape)
+        self.sum_w_log_w = np.empty(shape)
+        self.noise = np.empty(shape)
+        self.reset(np.arange(batch_size))
+
+
+    def reset(self, maps):
+        """
+        Start a fresh attempt for the given batch members.
+        """
+        self.wave[maps] = True
+        self.counts[maps] = self.num_patterns
+        self.sum_w[maps] = self.weights.sum()
+        self.sum_w_log_w[maps] = self.weight_log_weight.sum()
+        self.noise[maps] = self.rng.random((len(maps), self.height, self.width)) * 1e-6
+
+
+    def entropies(self):
+        """
+        Entropy of every cell, +inf for cells that are already decided.
+        """
+        # Contradicted cells of failed maps have no weight left; their entropy is discarded anyway
+        with np.errstate(divide='ignore', invalid='ignore'):
+            entropy = np.log2(self.sum_w) - self.sum_w_log_w / self.sum_w + self.noise
+        return np.where(self.counts > 1, entropy, np.inf)
+
+
+    def update_cells(self, b, y, x):
+        """
+        Recompute the pattern counts and weight sums of the given cells from the wave.
+        """
+        rows = self.wave[b, y, x]
+        self.counts[b, y, x] = rows.sum(axis=1)
+        self.sum_w[b, y, x] = rows @ self.weights
+        self.sum_w_log_w[b, y, x] = rows @ self.weight_log_weight
+
+
+    def run_step(self):
+        """
+        Collapse the minimal entropy cell of every unfinished map and propagate.
+        Returns False once every map is fully collapsed or has failed.
+        """
+        entropy = self.entropies().reshape(self.batch_size, -1)
+        entropy[self.failed] = np.inf
+        cells = entropy.argmin(axis=1)
+        active = np.flatnonzero(np.isfinite(entropy[np.arange(self.batch_size), cells]))
+        if len(active) == 0:
+            return False
+
+        # Sample one pattern per observed cell, proportional to the weights of its remaining patterns
+        y, x = np.divmod(cells[active], self.width)
+        rows = self.wave[active, y, x] * self.weights
+        cumulative = np.cumsum(rows, axis=1)
+        threshold = self.rng.random(len(active)) * cumulative[:, -1]
+        chosen = (cumulative > threshold[:, None]).argmax(axis=1)
+
+        self.wave[active, y, x] = False
+        self.wave[active, y, x, chosen] = True
+        self.update_cells(active, y, x)
+
+        self.propagate(active, y, x)
+        return True
+
+
+    def propagate(self, b, y, x):
+        """
+        Propagate from a frontier of changed cells (b, y, x) until no domain changes, restarting
+        the maps whose waves hit a contradiction.
+        """
+        while len(b):
+            # Classes present in each frontier cell's domain, for all directions at once
+            present = (self.wave[b, y, x].astype(np.float32) @ self.membership) > 0
+
+            changed = []
+            for direction, (dx, dy) in enumerate(DIRECTIONS):
+                nx, ny = x + dx, y + dy
+                inside = (0 <= nx) & (nx < self.width) & (0 <= ny) & (ny < self.height)
+                nb, nx, ny = b[inside], nx[inside], ny[inside]
+
+                # Union of the compatibility rows of each frontier cell's remaining patterns, via their classes
+                classes = present[inside][:, self.class_slices[direction]]
+                support = (classes.astype(np.float32) @ self.rows[direction]) > 0
+
+                old = self.wave[nb, ny, nx]
+                new = old & support
+
+                shrunk = (new != old).any(axis=1)
+                self.wave[nb[shrunk], ny[shrunk], nx[shrunk]] = new[shrunk]
+                changed.append(np.ravel_multi_index((nb[shrunk], ny[shrunk], nx[shrunk]), self.counts.shape))
+
+            # Next frontier: every cell whose domain shrank, once
+            b, y, x = np.unravel_index(np.unique(np.concatenate(changed)), self.counts.shape)
+            self.update_cells(b, y, x)
+
+            contradicted = np.unique(b[self.counts[b, y, x] == 0])
+            if len(contradicted):
+                self.restart(contradicted)
+                keep = ~np.isin(b, contradicted)
+                b, y, x = b[keep], y[keep], x[keep]
+
+
+    def restart(self, maps):
+        """
+        Restart the contradicted maps, or mark them failed once their restart budget is spent.
+        """
+        exhausted = self.restarts[maps] >= self.max_restarts
+        self.failed[maps[exhausted]] = True
+
+        retry = maps[~exhausted]
+        self.restarts[retry] += 1
+        self.reset(retry)
+
+
+    def render(self):
+        """
+        Render every map to a 2D grid of center tiles, with '?' for undecided cells.
+        """
+        output = np.where(self.counts == 1, self.center_tiles[self.wave.argmax(axis=3)], '?')
+        return [grid.tolist() for grid in output]
@@ -1,23 +1,37 @@
+import os
+import json
+import hashlib
+import time
+import random
 import pygame
 import argparse
+import numpy as np
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
 
 # Try because when you run this file directly, you cant use . since it is not a package.
 try:
     from .UI import UI
-    from .WFC import OverlappingWFC
+    from .WFC import OverlappingWFC, BitsetWFC, BatchedWFC, bitset_tables
     from .helper import *
     from .repair import repair
     from .fill_tiles import fill_tiles
 except ImportError:
     from UI import UI
-    from WFC import OverlappingWFC
+    from WFC import OverlappingWFC, BitsetWFC, BatchedWFC, bitset_tables
     from helper import *
     from repair import repair
     from fill_tiles import fill_tiles
 
+# Available solver engines: 'set' keeps a Python set per cell, 'bitset' keeps a packed (H, W, P / 64) bitset
+ENGINES = {
+    'set': OverlappingWFC,
+    'bitset': BitsetWFC,
+}
 
-def run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_window_size):
+
+def run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_window_size, engine="bitset", propagator="ac3",
+                               max_backtracks=100, max_restarts=3, backend="numpy"):
     """
     Run the WFC algorithm with real-time Pygame visualization and interactive UI controls.
     """
@@ -31,14 +45,13 @@ def run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_win
         map_height = min(map_size[1], MAX_MAP_SIZE)
 
         # Pattern extraction and rule generation
-        patterns = extract_patterns(training_map, N)
-        catalog, weights = build_pattern_catalog(patterns)
-        tile_adj = compute_tile_adjacency(training_map)
-        adjacency = build_adjacency_rules(catalog, tile_adj)
+        catalog, weights, adjacency = compile_rules(training_map, N)
 
         # Initialize WFC solver
-        wfc = OverlappingWFC(map_width, map_height, catalog, weights, adjacency)
+        wfc = ENGINES[engine](map_width, map_height, catalog, weights, adjacency, propagator=propagator,
+                              max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend)
         output = wfc.render()
+        steps = wfc.iter_steps() # Per-step deltas of the cells that changed
 
         generating = True # Indicates if WFC is still running
         
@@ -98,11 +111,14 @@ def run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_win
                 if do_fill:
                     fill_tiles(output)
             
-            # Run WFC step-by-step
+            # Run WFC step-by-step, applying only the cells that changed
             if generating:
-                if not wfc.run_step():
+                updates = next(steps, None)
+                if updates is None:
                     generating = False
-                output = wfc.render()
+                else:
+                    for x, y, tile, _ in updates:
+                        output[y][x] = tile
 
             # Update and render UI
             ui.update(dt, generating)
@@ -111,83 +127,774 @@ def run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_win
     pygame.quit()
 
 
-def run_wfc(training_map, N, map_size):
+def compile_mixed_rules(training_map, N, style_mix=None, map_names=None):
+    """
+    Compile the rules of the training maps. With style_mix, the weights are recomputed from the
+    cached per-map pattern counts instead of recompiling (see style_mix_vector and style_weights),
+    which needs the map_names returned by load_all_maps; a ValueError is raised without them.
+    """
+    if style_mix is None:
+        return compile_rules(training_map, N)
+    if map_names is None:
+        raise ValueError("style_mix needs map_names, the training map names returned by load_all_maps(..., return_names=True)")
+
+    catalog, _, adjacency, map_counts = compile_rules(training_map, N, return_map_counts=True)
+    weights = style_weights(map_counts, style_mix_vector(map_names, style_mix))
+    return catalog, weights, adjacency
+
+
+def initial_constraints(catalog, map_size, seal_borders=False, template_path=None):
+    """
+    Build the initial wave constraints of a run: template cells keep their tiles and, with
+    seal_borders, border cells are limited to void or wall. Cells outside the map are ignored.
+    """
+    constraints = []
+    if template_path is not None:
+        constraints.append(template_constraints(catalog, load_template(template_path)))
+    if seal_borders:
+        constraints.append(border_constraints(catalog, map_size[0], map_size[1]))
+
+    fixed = merge_constraints(*constraints)
+    return {(x, y): patterns for (x, y), patterns in fixed.items() if x < map_size[0] and y < map_size[1]}
+
+
+def checkpoint_path(save_path):
+    """
+    Path of the solver checkpoint kept next to a map while it is generated.
+    """
+    return os.path.splitext(save_path)[0] + "_checkpoint.npz"
+
+
+def job_key(training_map, N, weights, size, fixed=None, **options):
+    """
+    Describe everything that determines a generated map as JSON data, so a rerun only reuses
+    maps and checkpoints of the same job: the size, the rules (training maps, N and the pattern
+    weights, which style_mix changes), the fixed cells and the given solver options.
+    """
+    rules = hashlib.sha256(rules_cache_key(training_map, N, True).encode()
+                           + np.asarray(weights, dtype=float).tobytes())
+    for (x, y), patterns in sorted((fixed or {}).items()):
+        rules.update(np.array([x, y, len(patterns), *patterns], dtype=np.int64).tobytes())
+    return json.loads(json.dumps({
+        'size': list(size),
+        'N': N,
+        'rules': rules.hexdigest()[:16],
+        'solver_options': options,
+    }))
+
+
+def run_solver(wfc, progress=True, max_steps=None, max_seconds=None, checkpoint=None, checkpoint_every=None, job=None):
+    """
+    Run a WFC solver to completion with a progress bar and report how many backtracks
+    and restarts it needed. If max_steps or max_seconds is given and runs out first, the
+    solver stops and every undecided cell gets its highest-weight remaining pattern.
+    With checkpoint_every, the solver state is saved to the checkpoint path every that many
+    steps, and a run finding an existing checkpoint resumes from it, including the steps
+    already spent on the max_steps budget; the checkpoint is removed once the run ends.
+    job (see job_key) is stored with the checkpoint, and a checkpoint of another job is discarded.
+    Returns the rendered map and a dict with these counts and whether a budget was hit.
+    """
+    deadline = None if max_seconds is None else time.perf_counter() + max_seconds
+    steps = 0
+    budget_hit = False
+
+    if checkpoint_every and os.path.exists(checkpoint):
+        metadata = wfc.checkpoint_metadata(checkpoint)
+        if metadata is None or metadata.get('job') != job:
+            # Left behind by a different job (e.g. another size or template): never resume from it
+            print(f"Discarding checkpoint of a different job: {checkpoint}")
+            os.remove(checkpoint)
+        else:
+            steps = wfc.load_state(checkpoint).get('steps', 0)
+            print(f"Resuming from checkpoint: {checkpoint} after {steps} steps")
+
+    # Display progress bar while generating map
+    with tqdm(total=wfc.width * wfc.height, initial=int(wfc.collapsed.sum()), desc="Generating map",
+              disable=not progress) as pbar:
+        while wfc.run_step():
+            steps += 1
+            pbar.update(int(wfc.collapsed.sum()) - pbar.n) # A step may collapse several cells
+            pbar.set_postfix(backtracks=wfc.backtracks, restarts=wfc.restarts, refresh=False)
+
+            if checkpoint_every and steps % checkpoint_every == 0:
+                wfc.save_state(checkpoint, {'steps': steps, 'job': job})
+
+            # Stop at the step or time budget, whichever comes first
+            if (max_steps is not None and steps >= max_steps) or (deadline is not None and time.perf_counter() >= deadline):
+                budget_hit = True
+                break
+        output = wfc.render_best() if budget_hit else wfc.render()
+        pbar.refresh()
+
+    if checkpoint_every and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    stats = {'backtracks': wfc.backtracks, 'restarts': wfc.restarts, 'failed': wfc.failed,
+             'steps': steps, 'budget_hit': budget_hit}
+    if wfc.stats is not None:
+        stats['solver'] = wfc.stats.as_dict()
+    print(f"Generation needed {wfc.backtracks} backtracks and {wfc.restarts} restarts")
+    if budget_hit:
+        print(f"Warning: budget exhausted after {steps} steps, undecided cells use their highest-weight pattern")
+    if wfc.failed:
+        print("Warning: contradiction could not be resolved within the budget, map is incomplete")
+    return output, stats
+
+
+def run_wfc(training_map, N, map_size, engine="bitset", propagator="ac3", max_backtracks=100, max_restarts=3,
+            backend="numpy", max_steps=None, max_seconds=None, seal_borders=False, template_path=None,
+            checkpoint_every=None, observations=1, style_mix=None, map_names=None):
     """
     Run the WFC algorithm in batch mode, then apply repair and save the final map.
+    Returns the backtrack/restart statistics of the run (see run_solver for the budgets
+    and checkpoints, and initial_constraints for seal_borders and template_path).
+    observations is the number of distant cells collapsed per step (see WFCSolver),
+    style_mix reweights the patterns by training map (see compile_mixed_rules) and then
+    needs the map_names returned by load_all_maps.
     """
     # Pattern extraction and rule generation
-    patterns = extract_patterns(training_map, N)
-    catalog, weights = build_pattern_catalog(patterns)
-    tile_adj = compute_tile_adjacency(training_map)
-    adjacency = build_adjacency_rules(catalog, tile_adj)
+    catalog, weights, adjacency = compile_mixed_rules(training_map, N, style_mix, map_names)
+    fixed = initial_constraints(catalog, map_size, seal_borders, template_path)
     
     # Initialize WFC
-    wfc = OverlappingWFC(map_size[0], map_size[1], catalog, weights, adjacency)
+    wfc = ENGINES[engine](map_size[0], map_size[1], catalog, weights, adjacency, propagator=propagator,
+                          max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend, fixed=fixed,
+                          observations=observations)
 
-    output = None
-    # Display progress bar while generating map
-    with tqdm(total=map_size[0] * map_size[1], desc="Generating map") as pbar:
-        while wfc.run_step():
-            pbar.update(1)
-        output = wfc.render()
-        pbar.total = map_size[0] * map_size[1]
-        pbar.refresh()
+    job = job_key(training_map, N, weights, map_size, fixed, engine=engine, propagator=propagator,
+                  max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend,
+                  max_steps=max_steps, max_seconds=max_seconds, observations=observations)
+    output, stats = run_solver(wfc, max_steps=max_steps, max_seconds=max_seconds,
+                               checkpoint=checkpoint_path("generated_maps/generated_map.txt"),
+                               checkpoint_every=checkpoint_every, job=job)
 
     # Post-processing and save
     repair(output)
     fill_tiles(output)
     save_output(output)
+    return stats
 
 
-def call_wfc(training_map_path="training_map", save_path="generated_maps/generated_map.txt", N=3, map_size=(40,40)):
+def call_wfc(training_map_path="training_map", save_path="generated_maps/generated_map.txt", N=3, map_size=(40,40), engine="bitset", propagator="ac3",
+             max_backtracks=100, max_restarts=3, backend="numpy", max_steps=None, max_seconds=None, save_stats=False,
+             seal_borders=False, template_path=None, checkpoint_every=None, observations=1, style_mix=None):
     """
     Call function to run WFC with specified parameters.
     Used for running the entire program in one go.
+    Returns the backtrack/restart statistics of the run (see run_solver for the budgets
+    and checkpoints, and initial_constraints for seal_borders and template_path).
+    observations is the number of distant cells collapsed per step (see WFCSolver),
+    style_mix reweights the patterns by training map (see compile_mixed_rules).
+    With save_stats, the solver's counters and timings are collected as well and the
+    statistics are written as JSON next to the map (<map name>_stats.json).
     """
     # Load and combine training maps
-    training_map = load_all_maps(training_map_path)
+    training_map, map_names = load_all_maps(training_map_path, return_names=True)
 
     # Pattern extraction and rule generation
-    patterns = extract_patterns(training_map, N)
-    catalog, weights = build_pattern_catalog(patterns)
-    tile_adj = compute_tile_adjacency(training_map)
-    adjacency = build_adjacency_rules(catalog, tile_adj)
+    catalog, weights, adjacency = compile_mixed_rules(training_map, N, style_mix, map_names)
+    fixed = initial_constraints(catalog, map_size, seal_borders, template_path)
 
     # Initialize WFC
-    wfc = OverlappingWFC(map_size[0], map_size[1], catalog, weights, adjacency)
+    wfc = ENGINES[engine](map_size[0], map_size[1], catalog, weights, adjacency, propagator=propagator,
+                          max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend, fixed=fixed,
+                          observations=observations)
 
-    output = None
-    # Display progress bar while generating map
-    with tqdm(total=map_size[0] * map_size[1], desc="Generating map") as pbar:
-        while wfc.run_step():
-            pbar.update(1)
-        output = wfc.render()
-        pbar.total = map_size[0] * map_size[1]
-        pbar.refresh()
+    if save_stats:
+        wfc.enable_stats()
+
+    job = job_key(training_map, N, weights, map_size, fixed, engine=engine, propagator=propagator,
+                  max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend,
+                  max_steps=max_steps, max_seconds=max_seconds, observations=observations)
+    output, stats = run_solver(wfc, max_steps=max_steps, max_seconds=max_seconds,
+                               checkpoint=checkpoint_path(save_path), checkpoint_every=checkpoint_every, job=job)
+
+    # Post-processing and save
+    repair(output)
+    fill_tiles(output)
+    save_output(output, filename=save_path)
+
+    if save_stats:
+        stats_path = os.path.splitext(save_path)[0] + "_stats.json"
+        with open(stats_path, "w") as f:
+            json.dump(stats, f, indent=2)
+        print(f"Saved solver statistics to: {stats_path}")
+    return stats
+
+
+# Compiled rules and solver tables of the current batch worker process, set once by init_batch_worker,
+# and the shared memory block they live in (kept open for the life of the worker)
+worker_rules = None
+worker_tables = None
+worker_shared_memory = None
+
+
+def init_batch_worker(handle):
+    """
+    Attach a worker process to the rules published with SharedRules, so every worker
+    reads the same tables instead of holding its own copy.
+    """
+    global worker_rules, worker_tables, worker_shared_memory
+    worker_shared_memory, worker_rules, worker_tables = SharedRules.attach(handle)
+
+
+def shared_rules(rules, solver_options):
+    """
+    Publish rules for batch workers, together with the BitsetWFC tables when that engine is used.
+    """
+    tables = None
+    if solver_options['engine'] == 'bitset':
+        tables = bitset_tables(rules[2], solver_options['backend'])
+    return SharedRules(*rules, tables=tables)
+
+
+def worker_solver(size, seed, solver_options, **kwargs):
+    """
+    Build the solver of a batch task from the worker's shared rules and tables.
+    """
+    catalog, weights, adjacency = worker_rules
+    if worker_tables:
+        kwargs['tables'] = worker_tables
+    return ENGINES[solver_options['engine']](
+        size[0], size[1], catalog, weights, adjacency, seed=seed,
+        propagator=solver_options['propagator'],
+        max_backtracks=solver_options['max_backtracks'],
+        max_restarts=solver_options['max_restarts'],
+        backend=solver_options['backend'],
+        **kwargs
+    )
+
+
+def manifest_path(save_path):
+    """
+    Path of the manifest recording which batch job a map and its checkpoint belong to.
+    """
+    return os.path.splitext(save_path)[0] + "_manifest.json"
+
+
+def read_manifest(save_path):
+    """
+    Return the manifest saved next to a map, or None if there is none (or it is unreadable).
+    """
+    try:
+        with open(manifest_path(save_path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(save_path, job, complete):
+    """
+    Record the job of a map and whether the map is complete, replacing the manifest atomically.
+    """
+    path = manifest_path(save_path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'job': job, 'complete': complete}, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def generate_batch_map(task):
+    """
+    Generate, repair, fill and save a single map inside a batch worker process.
+    Each map gets its own seed sequence, so results do not depend on the number of workers.
+    With checkpoints enabled, a manifest next to the map records its job (seed, size, rules and
+    solver options): a map whose manifest matches and is marked complete is skipped, and a
+    checkpoint is only resumed if it belongs to the same job (see run_solver).
+    """
+    index, size, seed_sequence, save_path, solver_options, job = task
+    checkpoint_every = solver_options['checkpoint_every']
+    checkpoint = checkpoint_path(save_path)
+    stats = {'backtracks': 0, 'restarts': 0, 'failed': False, 'steps': 0, 'budget_hit': False}
+
+    try:
+        if checkpoint_every:
+            manifest = read_manifest(save_path)
+            if manifest is not None and manifest['job'] == job and manifest['complete'] and os.path.exists(save_path):
+                return dict(stats, skipped=True, index=index, path=save_path)
+            write_manifest(save_path, job, complete=False)
+
+        # Seed the solver and the global RNG used by fill_tiles from the map's own stream
+        solver_seed, fill_seed = seed_sequence.spawn(2)
+        random.seed(int(fill_seed.generate_state(1)[0]))
+
+        wfc = worker_solver(size, solver_seed, solver_options, observations=solver_options['observations'])
+        output, stats = run_solver(wfc, progress=False, max_steps=solver_options['max_steps'],
+                                   max_seconds=solver_options['max_seconds'], checkpoint=checkpoint,
+                                   checkpoint_every=checkpoint_every, job=job)
+
+        # Post-processing and save
+        repair(output)
+        fill_tiles(output)
+        save_output(output, filename=save_path)
+        if checkpoint_every:
+            write_manifest(save_path, job, complete=True)
+    except Exception as e:
+        # One broken map (e.g. fill_tiles on a map without enough floor) must not abort the batch
+        return dict(stats, failed=True, error=f"{type(e).__name__}: {e}", index=index, path=save_path)
+    return dict(stats, index=index, path=save_path)
+
+
+def generate_batch(n, size, N=3, workers=None, seed=None, training_map_path="training_map",
+                   save_dir="generated_maps", prefix="generated_map", engine="bitset", propagator="ac3",
+                   max_backtracks=100, max_restarts=3, backend="numpy", max_steps=None, max_seconds=None,
+                   checkpoint_every=None, observations=1, style_mix=None):
+    """
+    Generate n maps of the given size with a process pool, each within the optional
+    max_steps/max_seconds budget of run_solver. The rules are compiled once and
+    shared with every worker through shared memory; map i is saved as <save_dir>/<prefix>_<i>.txt.
+    With checkpoint_every, every map checkpoints its solver and a rerun of an interrupted batch
+    (same seed) skips finished maps and resumes interrupted ones. The manifests recording this
+    are removed once the batch finishes, so the folder only holds the maps.
+    style_mix reweights the patterns by training map (see compile_mixed_rules).
+    Returns the backtrack/restart statistics of every map, ordered by index. A map whose generation
+    raised is reported as failed with the message under 'error', and the rest of the batch carries on.
+    """
+    # Load training maps and compile the rules once for the whole batch
+    training_map, map_names = load_all_maps(training_map_path, return_names=True)
+    rules = compile_mixed_rules(training_map, N, style_mix, map_names)
+
+    # One independent, reproducible seed sequence per map
+    os.makedirs(save_dir, exist_ok=True)
+    solver_options = {
+        'engine': engine,
+        'propagator': propagator,
+        'max_backtracks': max_backtracks,
+        'max_restarts': max_restarts,
+        'backend': backend,
+        'max_steps': max_steps,
+        'max_seconds': max_seconds,
+        'checkpoint_every': checkpoint_every,
+        'observations': observations,
+    }
+
+    # Everything that determines a map, so a rerun only reuses maps and checkpoints of the same job
+    options = {key: value for key, value in solver_options.items() if key != 'checkpoint_every'}
+    batch_job = job_key(training_map, N, rules[1], size, **options)
+
+    def job(seed_sequence):
+        return dict(batch_job, seed=json.loads(json.dumps([seed_sequence.entropy, list(seed_sequence.spawn_key)])))
+
+    tasks = [
+        (i, size, seed_sequence, os.path.join(save_dir, f"{prefix}_{i}.txt"), solver_options, job(seed_sequence))
+        for i, seed_sequence in enumerate(np.random.SeedSequence(seed).spawn(n))
+    ]
+
+    results = []
+    with shared_rules(rules, solver_options) as shared, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(shared.handle,)) as pool:
+        for stats in tqdm(pool.map(generate_batch_map, tasks), total=n, desc="Generating maps"):
+            results.append(stats)
+
+    # Manifests are only needed to resume an interrupted batch, so a finished one leaves nothing but the maps
+    if checkpoint_every:
+        for task in tasks:
+            if os.path.exists(manifest_path(task[3])):
+                os.remove(manifest_path(task[3]))
+
+    errors = [r for r in results if 'error' in r]
+    print(f"Generated {n - len(errors)} of {n} maps with {sum(r['backtracks'] for r in results)} backtracks "
+          f"and {sum(r['restarts'] for r in results)} restarts in total")
+    if any(r['budget_hit'] for r in results):
+        print(f"Warning: {sum(r['budget_hit'] for r in results)} maps hit their budget")
+    if errors:
+        print(f"Warning: {len(errors)} maps raised an error and were not saved:")
+        for r in errors:
+            print(f"  {r['path']}: {r['error']}")
+    return results
+
+
+def generate_tensor_batch(n, size, N=3, batch_size=64, seed=None, training_map_path="training_map",
+                          save_dir="generated_maps", prefix="generated_map", max_restarts=10, style_mix=None):
+    """
+    Generate n maps of the given size with BatchedWFC, solving batch_size maps at a time in one
+    process. Like generate_batch, map i is repaired, filled and saved as <save_dir>/<prefix>_<i>.txt.
+    Returns the restart statistics of every map, ordered by index. A map that found no solution or
+    whose post-processing raised is reported as failed with the message under 'error', and is not saved.
+    """
+    training_map, map_names = load_all_maps(training_map_path, return_names=True)
+    catalog, weights, adjacency = compile_mixed_rules(training_map, N, style_mix, map_names)
+
+    os.makedirs(save_dir, exist_ok=True)
+    seed_sequences = np.random.SeedSequence(seed).spawn(n)
+
+    results = []
+    with tqdm(total=n, desc="Generating maps") as pbar:
+        for start in range(0, n, batch_size):
+            count = min(batch_size, n - start)
+
+            # One solver stream for the whole batch, one fill_tiles stream per map
+            wfc = BatchedWFC(count, size[0], size[1], catalog, weights, adjacency,
+                             seed=seed_sequences[start].spawn(1)[0], max_restarts=max_restarts)
+            while wfc.run_step():
+                pass
+
+            for offset, output in enumerate(wfc.render()):
+                index = start + offset
+                random.seed(int(seed_sequences[index].generate_state(1)[0]))
+                save_path = os.path.join(save_dir, f"{prefix}_{index}.txt")
+                stats = {'index': index, 'path': save_path, 'backtracks': 0,
+                         'restarts': int(wfc.restarts[offset]), 'failed': bool(wfc.failed[offset])}
+                pbar.update(1)
+
+                # A member that ran out of restarts still holds contradictions: report it instead of saving
+                if stats['failed']:
+                    results.append(dict(stats, error=f"no solution after {stats['restarts']} restarts"))
+                    continue
+
+                # Post-processing and save; one broken map must not abort the batch
+                try:
+                    repair(output)
+                    fill_tiles(output)
+                    save_output(output, filename=save_path)
+                except Exception as e:
+                    stats.update(failed=True, error=f"{type(e).__name__}: {e}")
+                results.append(stats)
+
+    errors = [r for r in results if 'error' in r]
+    print(f"Generated {n - len(errors)} of {n} maps with {sum(r['restarts'] for r in results)} restarts in total")
+    if errors:
+        print(f"Warning: {len(errors)} maps failed and were not saved:")
+        for r in errors:
+            print(f"  {r['path']}: {r['error']}")
+    return results
+
+
+def solve_region(task):
+    """
+    Solve one rectangular region inside a batch worker process, with the given cells fixed.
+    Returns the collapsed patterns of the region (-1 where undecided) and the solver statistics.
+    """
+    size, fixed, seed_sequence, solver_options = task
+
+    wfc = worker_solver(size, seed_sequence, solver_options, fixed=fixed)
+    while wfc.run_step():
+        pass
+    return wfc.collapsed_patterns(), {'backtracks': wfc.backtracks, 'restarts': wfc.restarts, 'failed': wfc.failed}
+
+
+def region_task(grid, bounds, seed_sequence, solver_options):
+    """
+    Build the solve_region task that re-solves grid[y0:y1, x0:x1] (clipped to the map).
+    Decided cells on the outer ring of the region stay fixed, so the result fits its surroundings.
+    """
+    x0, y0, x1, y1 = bounds
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, grid.shape[1]), min(y1, grid.shape[0])
+    region = grid[y0:y1, x0:x1]
+
+    ring = np.zeros(region.shape, dtype=bool)
+    ring[[0, -1], :] = True
+    ring[:, [0, -1]] = True
+    fixed = {(x, y): [region[y, x]] for y, x in zip(*np.nonzero(ring & (region >= 0)))}
+    return (x1 - x0, y1 - y0), fixed, seed_sequence, solver_options
+
+
+def generate_parallel(training_map, N, map_size, regions=(2, 2), seam=4, workers=None, seed=None,
+                      save_path="generated_maps/generated_map.txt", engine="bitset", propagator="ac3",
+                      max_backtracks=100, max_restarts=3, backend="numpy"):
+    """
+    Generate one large map by domain decomposition. The map is split into regions[0] × regions[1]
+    blocks separated by seam-wide strips; the blocks are solved concurrently in a process pool,
+    then the vertical and horizontal strips are re-solved (again concurrently) with the block
+    cells around them fixed. A strip that cannot be solved is retried with a wider margin
+    reopened into its neighboring blocks. The map is then repaired, filled and saved like run_wfc.
+    Returns the summed backtrack/restart statistics and the number of failed regions.
+    """
+    rules = compile_rules(training_map, N)
+    width, height = map_size
+    grid = np.full((height, width), -1, dtype=np.int64)
+    seeds = np.random.SeedSequence(seed)
+    stats = {'backtracks': 0, 'restarts': 0, 'failed_regions': 0}
+    solver_options = {
+        'engine': engine,
+        'propagator': propagator,
+        'max_backtracks': max_backtracks,
+        'max_restarts': max_restarts,
+        'backend': backend,
+    }
+
+    # Seam strips [start, start + seam) centered on evenly spaced cuts, and the block spans between them
+    def split(length, count):
+        starts = [int(c) - seam // 2 for c in np.linspace(0, length, count + 1)[1:-1]]
+        edges = [0] + [e for s in starts for e in (s, s + seam)] + [length]
+        return starts, list(zip(edges[::2], edges[1::2]))
+
+    x_seams, x_blocks = split(width, regions[0])
+    y_seams, y_blocks = split(height, regions[1])
+    min_block = min(end - start for start, end in x_blocks + y_blocks)
+    if min_block <= 2 * seam:
+        raise ValueError(f"Map of {width}x{height} is too small for {regions[0]}x{regions[1]} regions with seam {seam}")
+
+    # Margins reopened into the blocks when a strip fails, kept small enough that strips never overlap
+    margins = [m for m in (0, seam, 2 * seam) if 2 * m + 2 < min_block]
+
+    def solve(pool, bounds_list, desc):
+        tasks = [region_task(grid, bounds, seeds.spawn(1)[0], solver_options) for bounds in bounds_list]
+        results = list(tqdm(pool.map(solve_region, tasks), total=len(tasks), desc=desc))
+        for _, region_stats in results:
+            stats['backtracks'] += region_stats['backtracks']
+            stats['restarts'] += region_stats['restarts']
+        return results
+
+    def place(bounds, patterns):
+        x0, y0 = max(bounds[0], 0), max(bounds[1], 0)
+        grid[y0:y0 + patterns.shape[0], x0:x0 + patterns.shape[1]] = patterns
+
+    with shared_rules(rules, solver_options) as shared, \
+            ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(shared.handle,)) as pool:
+        # Independent block interiors
+        blocks = [(x0, y0, x1, y1) for y0, y1 in y_blocks for x0, x1 in x_blocks]
+        for bounds, (patterns, region_stats) in zip(blocks, solve(pool, blocks, "Solving blocks")):
+            place(bounds, patterns)
+            stats['failed_regions'] += region_stats['failed']
+
+        # Vertical strips within each block row, then horizontal strips across the full width; each strip
+        # includes a one-cell frame of fixed cells on both sides and grows along (dx, dy) by the margin
+        vertical = [(s - 1, y0, s + seam + 1, y1, 1, 0) for y0, y1 in y_blocks for s in x_seams]
+        horizontal = [(0, s - 1, width, s + seam + 1, 0, 1) for s in y_seams]
+
+        for strips, desc in ((vertical, "Solving vertical seams"), (horizontal, "Solving horizontal seams")):
+            for attempt, margin in enumerate(margins):
+                bounds_list = [(x0 - dx * margin, y0 - dy * margin, x1 + dx * margin, y1 + dy * margin)
+                               for x0, y0, x1, y1, dx, dy in strips]
+                results = solve(pool, bounds_list, desc)
+                last = attempt == len(margins) - 1
+
+                retry = []
+                for strip, bounds, (patterns, region_stats) in zip(strips, bounds_list, results):
+                    if not region_stats['failed'] or last:
+                        place(bounds, patterns)
+                        stats['failed_regions'] += region_stats['failed']
+                    else:
+                        retry.append(strip)
+                strips = retry
+                if not strips:
+                    break
+
+    tiles = center_tiles(rules[0])
+    output = np.where(grid >= 0, tiles[grid], '?').tolist()
+    print(f"Generation needed {stats['backtracks']} backtracks and {stats['restarts']} restarts")
+    if stats['failed_regions']:
+        print(f"Warning: {stats['failed_regions']} regions could not be resolved within the budget, map is incomplete")
+
+    # Post-processing and save
+    repair(output)
+    fill_tiles(output)
+    save_output(output, filename=save_path)
+    return stats
+
+
+def generate_variants(training_map, N, map_size, variants, shared_steps, seed=None, save_dir="generated_maps",
+                      prefix="variant", engine="bitset", propagator="ac3", max_backtracks=100, max_restarts=3,
+                      backend="numpy"):
+    """
+    Generate a family of related maps: one solver runs shared_steps collapse steps, then it is
+    forked into variants children that finish with their own RNG streams, so the maps share the
+    layout decided so far. Map i is saved as <save_dir>/<prefix>_<i>.txt.
+    Returns the statistics of every variant.
+    """
+    catalog, weights, adjacency = compile_rules(training_map, N)
+    wfc = ENGINES[engine](map_size[0], map_size[1], catalog, weights, adjacency, propagator=propagator, seed=seed,
+                          max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend)
+
+    # Shared part of the layout
+    for _ in tqdm(range(shared_steps), desc="Shared steps"):
+        if not wfc.run_step():
+            break
+
+    os.makedirs(save_dir, exist_ok=True)
+    results = []
+    for i, child in enumerate(wfc.fork(variants)):
+        output, stats = run_solver(child)
+
+        # Post-processing and save
+        save_path = os.path.join(save_dir, f"{prefix}_{i}.txt")
+        repair(output)
+        fill_tiles(output)
+        save_output(output, filename=save_path)
+        results.append(dict(stats, index=i, path=save_path))
+    return results
+
+
+def generate_hierarchical(training_map, N, map_size, factor=2, coarse_N=None, seed=None,
+                          save_path="generated_maps/generated_map.txt", engine="bitset", propagator="ac3",
+                          max_backtracks=100, max_restarts=3, backend="numpy"):
+    """
+    Coarse-to-fine generation: learn a second catalog from the training maps downsampled by
+    factor, generate the coarse layout first, then solve the full-size map with the cells deep
+    inside the coarse layout's void already fixed (see void_constraints), so the fine solver only
+    observes the cells around the structure. The map is then repaired, filled and saved like run_wfc.
+    Returns the statistics of the coarse and the fine run.
+    """
+    width, height = map_size
+    coarse_size = (-(-width // factor), -(-height // factor))
+    coarse_seed, fine_seed = np.random.SeedSequence(seed).spawn(2)
+
+    # Coarse layout from the downsampled training maps
+    coarse_maps = [downsample_map(map_data, factor) for map_data in training_map]
+    catalog, weights, adjacency = compile_rules(coarse_maps, coarse_N or N)
+    wfc = ENGINES[engine](coarse_size[0], coarse_size[1], catalog, weights, adjacency, propagator=propagator,
+                          seed=coarse_seed, max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend)
+    layout, coarse_stats = run_solver(wfc)
+
+    # Fix the fine cells deep inside the coarse void, leaving only the rest to the fine solver
+    catalog, weights, adjacency = compile_rules(training_map, N)
+    fixed = void_constraints(catalog, layout, factor, width, height)
+
+    wfc = ENGINES[engine](width, height, catalog, weights, adjacency, propagator=propagator, seed=fine_seed,
+                          max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend, fixed=fixed)
+    if wfc.failed:
+        print("Warning: coarse layout contradicts the fine rules, solving without it")
+        wfc = ENGINES[engine](width, height, catalog, weights, adjacency, propagator=propagator, seed=fine_seed,
+                              max_backtracks=max_backtracks, max_restarts=max_restarts, backend=backend)
+    output, fine_stats = run_solver(wfc)
 
     # Post-processing and save
     repair(output)
     fill_tiles(output)
     save_output(output, filename=save_path)
+    return {'coarse': coarse_stats, 'fine': fine_stats}
+
+
+def generate_chunked(training_map, N, map_size, chunk_size, save_path="generated_maps/generated_map.txt", seed=None,
+                     engine="bitset", propagator="ac3", max_backtracks=100, max_restarts=3, backend="numpy"):
+    """
+    Generate an arbitrarily large map in chunk_size × chunk_size chunks in scanline order.
+    Each chunk is solved together with a frame of the already finalized cells above and to
+    its left, fixed to their patterns, so chunks join without seams. Finished strips of
+    chunks are streamed to save_path, so memory is bounded by chunk size times map width.
+    Repair and tile filling need the whole map and are not applied.
+    Returns the summed backtrack/restart statistics and the number of failed chunks.
+    """
+    catalog, weights, adjacency = compile_rules(training_map, N)
+    tiles = center_tiles(catalog)
+    width, height = map_size
+
+    # Patterns of the last finalized row, framing the next strip from above
+    above = None
+    stats = {'backtracks': 0, 'restarts': 0, 'failed_chunks': 0}
+    chunk_seeds = iter(np.random.SeedSequence(seed).spawn(-(-width // chunk_size) * -(-height // chunk_size)))
+
+    print(f"Saving generated map to: {save_path}")
+    with open(save_path, "w") as f, tqdm(total=width * height, desc="Generating map") as pbar:
+        for y0 in range(0, height, chunk_size):
+            chunk_height = min(chunk_size, height - y0)
+            strip = np.full((chunk_height, width), -1, dtype=np.int64)
+
+            for x0 in range(0, width, chunk_size):
+                chunk_width = min(chunk_size, width - x0)
+
+                # Frame offsets: one extra row above and one extra column to the left when they exist
+                fx = 1 if x0 > 0 else 0
+                fy = 1 if above is not None else 0
+                fixed = {}
+                if fy:
+                    for x in range(chunk_width + fx):
+                        if above[x0 - fx + x] >= 0:
+                            fixed[(x, 0)] = [above[x0 - fx + x]]
+                if fx:
+                    for y in range(chunk_height):
+                        if strip[y, x0 - 1] >= 0:
+                            fixed[(0, y + fy)] = [strip[y, x0 - 1]]
+
+                wfc = ENGINES[engine](chunk_width + fx, chunk_height + fy, catalog, weights, adjacency,
+                                      propagator=propagator, seed=next(chunk_seeds), max_backtracks=max_backtracks,
+                                      max_restarts=max_restarts, backend=backend, fixed=fixed)
+                while wfc.run_step():
+                    pass
+                strip[:, x0:x0 + chunk_width] = wfc.collapsed_patterns()[fy:, fx:]
+
+                stats['backtracks'] += wfc.backtracks
+                stats['restarts'] += wfc.restarts
+                stats['failed_chunks'] += wfc.failed
+                pbar.update(chunk_width * chunk_height)
+
+            # Stream the finished strip; undecided cells of failed chunks are written as '?'
+            write_output_rows(f, np.where(strip >= 0, tiles[strip], '?').tolist())
+            above = strip[-1]
+
+    print(f"Map saved successfully, dimensions: {width}x{height}\n")
+    print(f"Generation needed {stats['backtracks']} backtracks and {stats['restarts']} restarts")
+    if stats['failed_chunks']:
+        print(f"Warning: {stats['failed_chunks']} chunks could not be resolved within the budget, map is incomplete")
+    return stats
 
 
 if __name__ == "__main__":
     # Command-line arg to toggle visualization
     parser = argparse.ArgumentParser(description="Generate a map using Wave Function Collapse")
     parser.add_argument('--visualize', action='store_true', help="Enable visualization")
+    parser.add_argument('--engine', choices=ENGINES.keys(), default="bitset", help="Wave representation used by the solver")
+    parser.add_argument('--propagator', choices=["ac3", "ac4"], default="ac3", help="Constraint propagation algorithm. ac4 keeps "
+                        "an int16 support counter per cell, direction and pattern (about 220 MB at 120x120) and runs about "
+                        "3x slower than ac3 on the bitset engine")
+    parser.add_argument('--backend', choices=["numpy", "numba"], default="numpy", help="Propagation backend of the bitset engine")
+    parser.add_argument('--max-backtracks', type=int, default=100, help="Backtracks allowed per attempt before restarting")
+    parser.add_argument('--max-restarts', type=int, default=3, help="Restarts allowed after running out of backtracks")
+    parser.add_argument('--max-steps', type=int, default=None, help="Step budget per map, after which undecided cells use a fallback")
+    parser.add_argument('--max-seconds', type=float, default=None, help="Time budget per map, after which undecided cells use a fallback")
+    parser.add_argument('--seal-borders', action='store_true', help="Start with border cells limited to void or wall")
+    parser.add_argument('--template', default=None, help="Text map whose tiles are fixed before generation ('?' = free)")
+    parser.add_argument('--observations', type=int, default=1, help="Distant cells collapsed together per step before propagating once")
+    parser.add_argument('--checkpoint-every', type=int, default=None, help="Save the solver state every this many steps and resume from it when rerun")
+    parser.add_argument('--style-mix', nargs='+', default=None, metavar='PREFIX=FACTOR', help="Reweight patterns by training map name prefix, e.g. E1=1 E3=0.5")
+    parser.add_argument('--batch', type=int, default=0, help="Generate this many maps with a process pool")
+    parser.add_argument('--tensor-batch', type=int, default=0, help="Solve batch maps this many at a time in one batched tensor solver")
+    parser.add_argument('--workers', type=int, default=None, help="Number of batch worker processes (default: all cores)")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the batch or chunked map, making it reproducible")
+    parser.add_argument('--map-size', type=int, nargs=2, default=(120, 120), metavar=('WIDTH', 'HEIGHT'), help="Size of generated maps")
+    parser.add_argument('--chunk-size', type=int, default=0, help="Generate one map of any size in chunks of this size")
+    parser.add_argument('--hierarchical', type=int, default=0, metavar='FACTOR', help="Generate a layout downsampled by FACTOR first, then only the full map's cells outside its void")
+    parser.add_argument('--regions', type=int, nargs=2, default=None, metavar=('X', 'Y'), help="Generate one map split into X by Y regions solved in parallel")
+    parser.add_argument('--seam', type=int, default=4, help="Width of the strips re-solved between parallel regions")
+    parser.add_argument('--variants', type=int, default=0, help="Generate this many variants of one map, forked after --shared-steps steps")
+    parser.add_argument('--shared-steps', type=int, default=1000, help="Collapse steps shared by all variants")
     args = parser.parse_args()
 
-    # Load input training maps
-    training_map = load_all_maps("training_map")
-    
     # Set default parameters
     N = 3
     MAX_MAP_SIZE = 150
-    map_size = (120, 120)   
+    map_size = tuple(args.map_size)
     base_window_size = (1000, 1000)
+    style_mix = None
+    if args.style_mix:
+        style_mix = {prefix: float(factor) for prefix, factor in (item.split('=') for item in args.style_mix)}
 
-    # Run with or without visualization
-    if args.visualize:
-        run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_window_size)
+    # Run in batch mode, or load input training maps and run with or without visualization
+    if args.batch and args.tensor_batch:
+        generate_tensor_batch(args.batch, map_size, N, args.tensor_batch, args.seed, max_restarts=args.max_restarts,
+                              style_mix=style_mix)
+    elif args.batch:
+        generate_batch(args.batch, map_size, N, args.workers, args.seed, engine=args.engine,
+                       propagator=args.propagator, max_backtracks=args.max_backtracks,
+                       max_restarts=args.max_restarts, backend=args.backend, max_steps=args.max_steps,
+                       max_seconds=args.max_seconds, checkpoint_every=args.checkpoint_every,
+                       observations=args.observations, style_mix=style_mix)
     else:
-        run_wfc(training_map, N, map_size)
\ No newline at end of file
+        training_map, map_names = load_all_maps("training_map", return_names=True)
+
+        if args.variants:
+            generate_variants(training_map, N, map_size, args.variants, args.shared_steps, args.seed,
+                              engine=args.engine, propagator=args.propagator, max_backtracks=args.max_backtracks,
+                              max_restarts=args.max_restarts, backend=args.backend)
+        elif args.hierarchical:
+            generate_hierarchical(training_map, N, map_size, args.hierarchical, seed=args.seed, engine=args.engine,
+                                  propagator=args.propagator, max_backtracks=args.max_backtracks,
+                                  max_restarts=args.max_restarts, backend=args.backend)
+        elif args.regions:
+            generate_parallel(training_map, N, map_size, tuple(args.regions), args.seam, args.workers, args.seed,
+                              engine=args.engine, propagator=args.propagator,
+                              max_backtracks=args.max_backtracks, max_restarts=args.max_restarts,
+                              backend=args.backend)
+        elif args.chunk_size:
+            generate_chunked(training_map, N, map_size, args.chunk_size, seed=args.seed, engine=args.engine,
+                             propagator=args.propagator, max_backtracks=args.max_backtracks,
+                             max_restarts=args.max_restarts, backend=args.backend)
+        elif args.visualize:
+            run_wfc_with_visualization(training_map, N, MAX_MAP_SIZE, map_size, base_window_size, args.engine,
+                                       args.propagator, args.max_backtracks, args.max_restarts, args.backend)
+        else:
+            run_wfc(training_map, N, map_size, args.engine, args.propagator, args.max_backtracks, args.max_restarts,
+                    args.backend, args.max_steps, args.max_seconds, args.seal_borders, args.template,
+                    args.checkpoint_every, args.observations, style_mix, map_names)
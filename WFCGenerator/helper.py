@@ -1,7 +1,19 @@
 import os
+import hashlib
+import numpy as np
 from PIL import Image
-from tqdm import tqdm
-from collections import defaultdict, Counter
+from scipy import sparse
+from multiprocessing import shared_memory
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Sanitized tile symbols; map arrays and array catalogs store a tile as its index in TILES
+TILES = np.array(['-', '.', 'X'])
+
+# Compiled rules are cached here, keyed by a hash of the training maps and compile settings
+RULES_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules_cache")
+
+# Bump when the compiled rule format or compilation itself changes, to invalidate old caches
+RULES_CACHE_VERSION = 5
 
 def load_map(filename):
     """
@@ -26,16 +38,18 @@ def load_map(filename):
     return [map_data]
 
 
-def load_all_maps(folder_path):
+def load_all_maps(folder_path, return_names=False):
     """
-    Load all .txt maps in a folder, sanitize each
+    Load all .txt maps in a folder in file name order, sanitize each
     line into valid tiles, and return a list of map grids.
+    With return_names, also return the file name (without extension) of every map.
     """
     print(f"\nLoading all maps from: {folder_path}")
 
     maps = []
+    names = []
     file_count = 0
-    for filename in os.listdir(folder_path):
+    for filename in sorted(os.listdir(folder_path)):
         if filename.endswith(".txt"):
             file_path = os.path.join(folder_path, filename)
             with open(file_path, 'r') as f:
@@ -45,9 +59,12 @@ def load_all_maps(folder_path):
                     lines.append(list(sanitized_line))
                 if lines:
                     maps.append(lines)
+                    names.append(os.path.splitext(filename)[0])
                     file_count += 1
 
     print(f"Loaded {file_count} maps\n")
+    if return_names:
+        return maps, names
     return maps
 
 
@@ -85,66 +102,250 @@ def save_output(output, filename="generated_maps/generated_map.txt"):
     print(f"Saving generated map to: {filename}")
 
     with open(filename, "w") as f:
-        for row in output:
-            f.write("".join(row) + "\n")
+        write_output_rows(f, output)
 
     print(f"Map saved successfully, dimensions: {len(output[0])}x{len(output)}\n")
 
 
-def extract_patterns(maps, N):
+def write_output_rows(f, rows):
     """
-    Extract all N×N tile patterns from each map by sliding a window 
-    over every possible position and return them as tuples.
+    Append map rows to an open text file in the format of save_output, so maps can be streamed row by row.
     """
-    print(f"Extracting {N}x{N} patterns")
+    for row in rows:
+        f.write("".join(row) + "\n")
 
-    patterns = []
-    pattern_count = 0
-    for map_data in maps:
-        height, width = len(map_data), len(map_data[0])
-        for y in range(height - N + 1):
-            for x in range(width - N + 1):
-                pattern = tuple(
-                    tuple(map_data[y + dy][x + dx] for dx in range(N))
-                    for dy in range(N)
-                )
-                patterns.append(pattern)
-                pattern_count += 1
 
-    print(f"Extracted {pattern_count} total {N}x{N} patterns")
-    return patterns
+def map_to_array(map_data):
+    """
+    Convert a sanitized map (list of rows of tile characters) into an (H, W) uint8 array of tile codes.
+    """
+    lookup = np.zeros(256, dtype=np.uint8)
+    for code, tile in enumerate(TILES):
+        lookup[ord(tile)] = code
+
+    chars = np.frombuffer("".join("".join(row) for row in map_data).encode(), dtype=np.uint8)
+    return lookup[chars].reshape(len(map_data), -1)
 
 
-def build_pattern_catalog(patterns):
+def downsample_map(map_data, factor):
     """
-    Build a catalog of unique patterns and corresponding 
-    weights based on their frequency in the training set.
+    Shrink a sanitized map by an integer factor: every factor × factor block becomes its most
+    common tile (ties go to the tile that comes first in TILES). Partial blocks at the
+    right and bottom edges are dropped.
     """
+    tiles = map_to_array(map_data)
+    height, width = tiles.shape[0] // factor, tiles.shape[1] // factor
+    blocks = tiles[:height * factor, :width * factor].reshape(height, factor, width, factor)
+
+    counts = np.stack([(blocks == code).sum(axis=(1, 3)) for code in range(len(TILES))], axis=-1)
+    return TILES[counts.argmax(axis=-1)].tolist()
+
+
+def void_constraints(catalog, layout, factor, width, height):
+    """
+    Fix the cells deep inside the void of a coarse layout to the all-void pattern, so the fine
+    solver never observes them. A block counts as void when its whole 3 × 3 coarse neighbourhood
+    is '-' (in the training maps such blocks hold nothing but void in all but ~0.1% of cases), and a
+    cell is fixed when the N × N window of its pattern lies in void blocks only.
+    Returns no constraints if the catalog has no all-void pattern.
+    """
+    tiles = np.asarray(catalog)
+    void_tile = 0 if tiles.dtype == np.uint8 else TILES[0]
+    void_pattern = np.flatnonzero((tiles == void_tile).all(axis=(1, 2)))
+    if len(void_pattern) == 0:
+        return {}
+
+    # Void blocks: every coarse cell of the 3 × 3 neighbourhood is '-' (outside the map counts as void)
+    void = np.array(layout) == TILES[0]
+    void = sliding_window_view(np.pad(void, 1, constant_values=True), (3, 3)).all(axis=(-2, -1))
+
+    # Fine cells whose whole pattern window is void
+    cells = np.repeat(np.repeat(void, factor, axis=0), factor, axis=1)[:height, :width]
+    r = len(catalog[0]) // 2
+    cells = sliding_window_view(np.pad(cells, r, constant_values=True), (2 * r + 1, 2 * r + 1)).all(axis=(-2, -1))
+    return {(x, y): void_pattern for y, x in zip(*np.nonzero(cells))}
+
+
+def extract_pattern_array(maps, N, return_map_counts=False):
+    """
+    Extract all N×N windows of every map at once and count them, packing each window into a
+    single integer key. Returns the catalog as a (P, N, N) uint8 array of tile codes, in order
+    of first appearance, and the weights as an integer array.
+    With return_map_counts, also return how often every pattern occurs in every map
+    as a sparse (maps, P) matrix whose column sums are the weights.
+    """
+    print(f"Extracting {N}x{N} patterns")
+
+    windows = [sliding_window_view(map_to_array(map_data), (N, N)).reshape(-1, N, N) for map_data in maps]
+    map_ids = np.repeat(np.arange(len(maps)), [len(w) for w in windows])
+    windows = np.concatenate(windows)
+
+    print(f"Extracted {len(windows)} total {N}x{N} patterns")
     print("Building pattern catalog")
 
-    counter = Counter(patterns)
-    catalog = list(counter.keys())
-    weights = [counter[p] for p in catalog]
+    flat = windows.reshape(len(windows), N * N)
+    if len(TILES) ** (N * N) < 2 ** 63:
+        # Base-3 key of every window, so counting is a single np.unique over integers
+        keys = flat.astype(np.int64) @ (len(TILES) ** np.arange(N * N, dtype=np.int64))
+        _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    else:
+        # Too many cells for one 64-bit key: count unique rows instead
+        _, first, inverse, counts = np.unique(flat, axis=0, return_index=True, return_inverse=True, return_counts=True)
+
+    order = np.argsort(first)
+    catalog = windows[first[order]]
+    weights = counts[order]
 
     print(f"Catalog contains {len(catalog)} unique patterns")
-    print(f"Most common pattern appears {max(weights)} times")
-    print(f"Least common pattern appears {min(weights)} times")
+    print(f"Most common pattern appears {weights.max()} times")
+    print(f"Least common pattern appears {weights.min()} times")
+
+    if return_map_counts:
+        # Catalog index of every window, then one count per (map, pattern) pair
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        patterns = rank[inverse.ravel()]
+        map_counts = sparse.csr_matrix((np.ones(len(patterns), dtype=np.int64), (map_ids, patterns)),
+                                       shape=(len(maps), len(catalog)))
+        return catalog, weights, map_counts
     return catalog, weights
 
 
-def pattern_match(p1, p2, direction):
-    """Check if two patterns p1 and p2 match along the given direction 
-    (0=up,1=right,2=down,3=left) by comparing their bordering rows or columns.
+def map_pattern_summary(map_data, N):
+    """
+    Summarize one map for incremental compiles: its unique N×N patterns in order of first
+    appearance, their counts, the window index of their first appearance, the number of
+    windows and a (4, T, T) boolean matrix of the tile pairs adjacent in each direction.
+    """
+    tiles = map_to_array(map_data)
+    windows = sliding_window_view(tiles, (N, N)).reshape(-1, N, N)
+    _, first, counts = np.unique(windows.reshape(len(windows), -1), axis=0, return_index=True, return_counts=True)
+    order = np.argsort(first)
+
+    # Neighbor above (direction 0) and to the right (direction 1); the opposite directions are transposes
+    tile_adj = np.zeros((4, len(TILES), len(TILES)), dtype=bool)
+    tile_adj[0][tiles[1:], tiles[:-1]] = True
+    tile_adj[1][tiles[:, :-1], tiles[:, 1:]] = True
+    tile_adj[2] = tile_adj[0].T
+    tile_adj[3] = tile_adj[1].T
+
+    return {
+        'patterns': windows[first[order]],
+        'counts': counts[order],
+        'first': first[order],
+        'windows': len(windows),
+        'tile_adj': tile_adj,
+    }
+
+
+def cached_map_summary(map_data, N, cache_dir):
+    """
+    Return the map_pattern_summary of a map, computing it only if no summary of a map
+    with the same content is cached in cache_dir.
+    """
+    path = os.path.join(cache_dir, f"patterns_N{N}_{rules_cache_key([map_data], N, None, None)}.npz")
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+    summary = map_pattern_summary(map_data, N)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **summary)
+    os.replace(tmp_path, path)
+    return summary
+
+
+def merge_map_summaries(summaries):
+    """
+    Combine per-map summaries into the catalog, weights and sparse per-map counts that
+    extract_pattern_array(..., return_map_counts=True) returns for the same maps, plus the
+    tile adjacency of all maps in the format of compute_tile_adjacency.
+    """
+    patterns = np.concatenate([summary['patterns'] for summary in summaries])
+    size = patterns.shape[1]
+    _, ids = np.unique(patterns.reshape(len(patterns), -1), axis=0, return_inverse=True)
+    ids = ids.ravel()
+
+    # A pattern's position in the catalog is its first window across the maps in order
+    offsets = np.cumsum([0] + [int(summary['windows']) for summary in summaries[:-1]])
+    positions = np.concatenate([offset + summary['first'] for offset, summary in zip(offsets, summaries)])
+    first = np.full(ids.max() + 1, np.iinfo(np.int64).max)
+    np.minimum.at(first, ids, positions)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    catalog = np.empty((len(order), size, size), dtype=np.uint8)
+    catalog[rank[ids]] = patterns
+    map_ids = np.repeat(np.arange(len(summaries)), [len(summary['patterns']) for summary in summaries])
+    counts = np.concatenate([summary['counts'] for summary in summaries]).astype(np.int64)
+    map_counts = sparse.csr_matrix((counts, (map_ids, rank[ids])), shape=(len(summaries), len(catalog)))
+    weights = np.asarray(map_counts.sum(axis=0)).ravel()
+
+    adjacent = np.logical_or.reduce([summary['tile_adj'] for summary in summaries])
+    tile_adj = {d: {(TILES[a], TILES[b]) for a, b in zip(*np.nonzero(adjacent[d]))} for d in range(4)}
+    return catalog, weights, map_counts, tile_adj
+
+
+def center_tiles(catalog):
+    """
+    Return the center tile character of every pattern, for tuple and uint8 array catalogs alike.
+    """
+    c = len(catalog[0]) // 2
+    if isinstance(catalog, np.ndarray) and catalog.dtype == np.uint8:
+        return TILES[catalog[:, c, c]]
+    return np.array([p[c][c] for p in catalog])
+
+
+def tile_constraints(catalog, cell_tiles):
+    """
+    Turn a {(x, y): tiles} mapping of allowed center tiles (e.g. "-X") into the
+    {(x, y): pattern indices} constraints accepted by the solvers' fixed argument.
+    """
+    centers = center_tiles(catalog)
+    return {cell: np.flatnonzero(np.isin(centers, list(tiles))) for cell, tiles in cell_tiles.items()}
+
+
+def border_constraints(catalog, width, height, tiles="-X"):
+    """
+    Constrain every cell on the map border to patterns with one of the given center tiles,
+    so the map starts sealed instead of relying on repair to fix its edges.
+    """
+    cells = {(x, y) for x in range(width) for y in (0, height - 1)}
+    cells |= {(x, y) for x in (0, width - 1) for y in range(height)}
+    return tile_constraints(catalog, {cell: tiles for cell in cells})
+
+
+def load_template(filename):
+    """
+    Load a template text map: cells holding a tile of TILES are fixed to that tile, any other
+    character (e.g. '?') leaves the cell free.
+    """
+    print(f"Loading template from: {filename}")
+
+    with open(filename, "r") as f:
+        return [list(line.rstrip("\n")) for line in f]
+
+
+def template_constraints(catalog, template, offset=(0, 0)):
+    """
+    Constrain the cells of a template (rows of characters) placed at offset to their tiles.
+    """
+    ox, oy = offset
+    cells = {(ox + x, oy + y): c for y, row in enumerate(template) for x, c in enumerate(row) if c in TILES}
+    return tile_constraints(catalog, cells)
+
+
+def merge_constraints(*constraints):
+    """
+    Combine constraint mappings; a cell constrained more than once keeps the patterns allowed by all of them.
     """
-    N = len(p1)
-    if direction == 0:
-        return all(p1[0][i] == p2[-1][i] for i in range(N))
-    elif direction == 1:
-        return all(p1[i][-1] == p2[i][0] for i in range(N))
-    elif direction == 2:
-        return all(p1[-1][i] == p2[0][i] for i in range(N))
-    elif direction == 3:
-        return all(p1[i][0] == p2[i][-1] for i in range(N))
+    merged = {}
+    for constraint in constraints:
+        for cell, patterns in constraint.items():
+            merged[cell] = np.intersect1d(merged[cell], patterns) if cell in merged else patterns
+    return merged
 
 
 def compute_tile_adjacency(maps):
@@ -167,30 +368,486 @@ def compute_tile_adjacency(maps):
     return tile_adj
 
 
+def pattern_borders(catalog):
+    """
+    Return a (4, P) array with integer signatures of the top, bottom, left and
+    right edge of every pattern; equal edges get equal signatures.
+    """
+    patterns = np.asarray(catalog)
+    edges = np.concatenate([patterns[:, 0, :], patterns[:, -1, :], patterns[:, :, 0], patterns[:, :, -1]])
+    _, signatures = np.unique(edges, axis=0, return_inverse=True)
+    return signatures.reshape(4, len(patterns))
+
+
+def join_borders(keys_a, keys_b):
+    """
+    Return all index pairs (i, j) with keys_a[i] == keys_b[j] by bucketing the
+    patterns on keys_b and joining every i with the bucket of its own key.
+    """
+    order = np.argsort(keys_b, kind='stable')
+    sorted_keys = keys_b[order]
+
+    # Bucket of every i as a range of the sorted order
+    starts = np.searchsorted(sorted_keys, keys_a, side='left')
+    lengths = np.searchsorted(sorted_keys, keys_a, side='right') - starts
+
+    first = np.repeat(np.arange(len(keys_a)), lengths)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    second = order[offsets + np.arange(lengths.sum())]
+    return first, second
+
+
+class AdjacencyRules:
+    def __init__(self, indptr, indices, num_patterns):
+        """
+        Adjacency rules stored as one CSR (indptr, indices) pair per direction:
+        the patterns allowed in direction d of pattern i are indices[d][indptr[d][i]:indptr[d][i + 1]].
+        Flat arrays are cheap to pickle, save and memory-map, unlike a dict of sets.
+        """
+        self.indptr = [np.asarray(a, dtype=np.int64) for a in indptr]
+        self.indices = [np.asarray(a, dtype=np.int32) for a in indices]
+        self.num_patterns = num_patterns
+
+
+    @classmethod
+    def from_pairs(cls, pairs, num_patterns):
+        """
+        Build rules from (first, second) index arrays per direction, meaning second may sit in direction d of first.
+        """
+        indptr, indices = [], []
+        for direction in range(4):
+            first, second = pairs[direction]
+            order = np.lexsort((second, first))
+            indptr.append(np.concatenate([[0], np.cumsum(np.bincount(first, minlength=num_patterns))]))
+            indices.append(second[order])
+        return cls(indptr, indices, num_patterns)
+
+
+    @classmethod
+    def from_sets(cls, adjacency, num_patterns):
+        """
+        Convert the legacy {pattern: [set per direction]} representation.
+        """
+        pairs = []
+        for direction in range(4):
+            rows = [sorted(adjacency[i][direction]) for i in range(num_patterns)]
+            first = np.repeat(np.arange(num_patterns), [len(row) for row in rows])
+            second = np.array([j for row in rows for j in row], dtype=np.int64)
+            pairs.append((first, second))
+        return cls.from_pairs(pairs, num_patterns)
+
+
+    def __len__(self):
+        return self.num_patterns
+
+
+    def __getitem__(self, i):
+        """
+        Return the allowed neighbors of pattern i as one index array per direction.
+        """
+        return [indices[indptr[i]:indptr[i + 1]] for indptr, indices in zip(self.indptr, self.indices)]
+
+
+    def num_rules(self):
+        return sum(len(indices) for indices in self.indices)
+
+
+    def rows(self, patterns, direction):
+        """
+        Concatenate the allowed neighbors in the given direction of all the given patterns (with repeats).
+        """
+        return gather_rows(self.indptr[direction], self.indices[direction], np.asarray(patterns))
+
+
+    def allowed(self, patterns, direction):
+        """
+        Return a boolean mask of the patterns allowed in the given direction by any of the given patterns.
+        """
+        mask = np.zeros(self.num_patterns, dtype=bool)
+        mask[self.rows(patterns, direction)] = True
+        return mask
+
+
+    def dense(self, direction):
+        """
+        Return the rules of one direction as a dense (P, P) boolean matrix; only sensible for small P.
+        """
+        matrix = np.zeros((self.num_patterns, self.num_patterns), dtype=bool)
+        rows = np.repeat(np.arange(self.num_patterns), np.diff(self.indptr[direction]))
+        matrix[rows, self.indices[direction]] = True
+        return matrix
+
+
+class SharedRules:
+    def __init__(self, catalog, weights, adjacency, tables=None):
+        """
+        Publish compiled rules as flat arrays in one multiprocessing.shared_memory block, so worker
+        processes can attach zero-copy views instead of each receiving a pickled copy.
+        tables optionally adds a dict of solver lookup tables built from the rules (e.g. the
+        packed rows of bitset_tables), so they are built once instead of once per solver.
+        Pass the small, picklable handle to the workers and call SharedRules.attach(handle) there.
+        The owner must close() the block (which also unlinks it) once the workers are done,
+        or use the instance as a context manager.
+        """
+        if not isinstance(adjacency, AdjacencyRules):
+            adjacency = AdjacencyRules.from_sets(adjacency, len(catalog))
+
+        arrays = {'catalog': np.asarray(catalog), 'weights': np.asarray(weights)}
+        for direction in range(4):
+            arrays[f'indptr_{direction}'] = adjacency.indptr[direction]
+            arrays[f'indices_{direction}'] = adjacency.indices[direction]
+        for key, table in (tables or {}).items():
+            arrays[f'table_{key}'] = np.asarray(table)
+
+        # (key, dtype, shape, offset) of every array, each aligned to 8 bytes
+        layout = []
+        size = 0
+        for key, array in arrays.items():
+            size = -(-size // 8) * 8
+            layout.append((key, array.dtype.str, array.shape, size))
+            size += array.nbytes
+
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for key, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)[...] = arrays[key]
+        self.handle = (self.shm.name, layout, len(arrays['catalog']))
+
+
+    @staticmethod
+    def attach(handle):
+        """
+        Attach to published rules and return the shared memory block, which must be kept open
+        as long as the rules are used, the (catalog, weights, adjacency) views into it and
+        a dict of views of the published tables (empty if there are none).
+        """
+        name, layout, num_patterns = handle
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = {key: np.ndarray(shape, dtype, buffer=shm.buf, offset=offset) for key, dtype, shape, offset in layout}
+        adjacency = AdjacencyRules(
+            [arrays[f'indptr_{d}'] for d in range(4)],
+            [arrays[f'indices_{d}'] for d in range(4)],
+            num_patterns
+        )
+        tables = {key[len('table_'):]: array for key, array in arrays.items() if key.startswith('table_')}
+        return shm, (arrays['catalog'], arrays['weights'], adjacency), tables
+
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def gather_rows(indptr, indices, rows):
+    """
+    Concatenate the CSR rows of the given pattern indices into a single index array.
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return indices[offsets + np.arange(lengths.sum())]
+
+
 def build_adjacency_rules(catalog, tile_adj=None):
     """
     Generate adjacency rules for each pattern index: 
     if two patterns match on their border and (optionally) their center 
     tiles respect training tile adjacency, allow that transition.
+    Matching borders are found by joining patterns on edge signatures,
+    and the result is returned as CSR AdjacencyRules.
     """
     print("Building adjacency rules")
 
-    adjacency = defaultdict(lambda: [set() for _ in range(4)])
-    total_rules = 0
-    for i, a in enumerate(tqdm(catalog, desc="Processing patterns")):
-        for j, b in enumerate(catalog):
-            for direction in range(4):
-                if not pattern_match(a, b, direction):
-                    continue
-                if tile_adj is not None:
-                    c = len(a) // 2
-                    t1 = a[c][c]
-                    t2 = b[c][c]
-                    if (t1, t2) not in tile_adj[direction]:
-                        continue
-                adjacency[i][direction].add(j)
-                total_rules += 1
+    top, bottom, left, right = pattern_borders(catalog)
+
+    # j fits above i if i's top row equals j's bottom row, and right of i if i's right column equals j's left column
+    pairs = {0: join_borders(top, bottom), 1: join_borders(right, left)}
+
+    # Opposite directions by symmetry: j above i <=> i below j, j right of i <=> i left of j
+    pairs[2] = pairs[0][::-1]
+    pairs[3] = pairs[1][::-1]
+
+    if tile_adj is not None:
+        # Vectorized center tile filter: allowed[d][code(t1), code(t2)] for every training tile pair
+        centers = center_tiles(catalog).tolist()
+        tiles = sorted(set(centers).union(*(t for d in range(4) for pair in tile_adj[d] for t in pair)))
+        codes = {t: k for k, t in enumerate(tiles)}
+        center_codes = np.array([codes[t] for t in centers])
+
+        allowed = np.zeros((4, len(tiles), len(tiles)), dtype=bool)
+        for d in range(4):
+            for t1, t2 in tile_adj[d]:
+                allowed[d, codes[t1], codes[t2]] = True
+
+        for d, (first, second) in pairs.items():
+            mask = allowed[d, center_codes[first], center_codes[second]]
+            pairs[d] = (first[mask], second[mask])
+
+    adjacency = AdjacencyRules.from_pairs(pairs, len(catalog))
+    total_rules = adjacency.num_rules()
 
     print(f"Generated {total_rules} adjacency rules for {len(catalog)} patterns")
     print(f"Average rules per pattern: {total_rules / len(catalog):.1f}\n")
-    return adjacency
\ No newline at end of file
+    return adjacency
+
+
+def tile_adjacency_matrix(tile_adj):
+    """
+    Convert compute_tile_adjacency's sets of tile pairs into a (4, T, T) boolean matrix over TILES codes.
+    """
+    codes = {tile: code for code, tile in enumerate(TILES)}
+    matrix = np.zeros((4, len(TILES), len(TILES)), dtype=bool)
+    for direction in range(4):
+        for a, b in (tile_adj or {}).get(direction, ()):
+            matrix[direction, codes[a], codes[b]] = True
+    return matrix
+
+
+def extend_adjacency_rules(catalog, tile_adj, base_catalog, base_adjacency):
+    """
+    Build the same rules as build_adjacency_rules(catalog, tile_adj) from the rules of an earlier
+    catalog compiled with the same tile adjacency: rules between patterns of both catalogs are
+    renumbered, and borders are joined only for patterns that are new to this catalog.
+    """
+    print("Extending adjacency rules")
+
+    # Index in catalog of every base pattern (-1 if it is gone), and which patterns are new
+    rows = np.concatenate([np.asarray(base_catalog), catalog]).reshape(len(base_catalog) + len(catalog), -1)
+    _, ids = np.unique(rows, axis=0, return_inverse=True)
+    ids = ids.ravel()
+    index_of = np.full(ids.max() + 1, -1)
+    index_of[ids[len(base_catalog):]] = np.arange(len(catalog))
+    base_index = index_of[ids[:len(base_catalog)]]
+    new = np.setdiff1d(np.arange(len(catalog)), base_index)
+    old = np.setdiff1d(np.arange(len(catalog)), new)
+
+    top, bottom, left, right = pattern_borders(catalog)
+    c = catalog.shape[1] // 2
+    centers = catalog[:, c, c]
+    allowed = tile_adjacency_matrix(tile_adj)
+    pairs = {}
+    for direction, (edge, other) in ((0, (top, bottom)), (1, (right, left))):
+        # Surviving base rules, then new patterns against all patterns and old patterns against new ones
+        owners = np.repeat(np.arange(len(base_catalog)), np.diff(base_adjacency.indptr[direction]))
+        first, second = base_index[owners], base_index[base_adjacency.indices[direction]]
+        keep = (first >= 0) & (second >= 0)
+
+        new_first, all_second = join_borders(edge[new], other)
+        old_first, new_second = join_borders(edge[old], other[new])
+        joined_first = np.concatenate([new[new_first], old[old_first]])
+        joined_second = np.concatenate([all_second, new[new_second]])
+        if tile_adj is not None:
+            mask = allowed[direction, centers[joined_first], centers[joined_second]]
+            joined_first, joined_second = joined_first[mask], joined_second[mask]
+
+        pairs[direction] = (np.concatenate([first[keep], joined_first]), np.concatenate([second[keep], joined_second]))
+
+    pairs[2] = pairs[0][::-1]
+    pairs[3] = pairs[1][::-1]
+    adjacency = AdjacencyRules.from_pairs(pairs, len(catalog))
+
+    print(f"Added rules for {len(new)} new patterns, {adjacency.num_rules()} adjacency rules "
+          f"for {len(catalog)} patterns\n")
+    return adjacency
+
+
+def prune_rules(catalog, weights, adjacency, map_counts=None):
+    """
+    Run arc consistency over the adjacency rules to a fixed point: a pattern without any
+    remaining compatible neighbor in some direction can never appear in the interior of a
+    map, so it is dropped together with its rules. Returns the renumbered catalog, weights
+    and adjacency rules, followed by the matching columns of map_counts if given.
+    """
+    print("Pruning unsupported patterns")
+
+    num_patterns = len(adjacency)
+    alive = np.ones(num_patterns, dtype=bool)
+    owners = [np.repeat(np.arange(num_patterns), np.diff(indptr)) for indptr in adjacency.indptr]
+
+    while True:
+        # A pattern survives if every direction still has at least one live neighbor
+        supported = alive.copy()
+        for direction in range(4):
+            live = alive[adjacency.indices[direction]]
+            supported &= np.bincount(owners[direction][live], minlength=num_patterns) > 0
+        if (supported == alive).all():
+            break
+        alive = supported
+
+    # Renumber the survivors and keep only the rules between them
+    new_index = np.cumsum(alive) - 1
+    pairs = []
+    for direction in range(4):
+        first, second = owners[direction], adjacency.indices[direction]
+        keep = alive[first] & alive[second]
+        pairs.append((new_index[first[keep]], new_index[second[keep]]))
+
+    pruned = AdjacencyRules.from_pairs(pairs, int(alive.sum()))
+    print(f"Pruned {num_patterns - len(pruned)} of {num_patterns} patterns, "
+          f"{pruned.num_rules()} adjacency rules remain\n")
+    if map_counts is not None:
+        return np.asarray(catalog)[alive], np.asarray(weights)[alive], pruned, map_counts[:, alive]
+    return np.asarray(catalog)[alive], np.asarray(weights)[alive], pruned
+
+
+def compile_rules(maps, N, use_tile_adj=True, prune=True, cache_dir=RULES_CACHE_DIR, return_map_counts=False):
+    """
+    Extract N×N patterns from the training maps and compile them into the
+    (P, N, N) uint8 pattern catalog, weights and adjacency rules used by the WFC solvers.
+    With prune, patterns that arc consistency proves unusable are removed (see prune_rules).
+    With return_map_counts, the sparse (maps, P) per-map pattern counts are returned as well,
+    for reweighting with style_weights.
+    Results are cached on disk in cache_dir (pass None to always recompile from scratch);
+    with a cache, a new map set is compiled incrementally (see compile_incremental).
+    """
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"rules_N{N}_{rules_cache_key(maps, N, use_tile_adj, prune)}.npz")
+        if os.path.exists(cache_path):
+            return load_rules(cache_path, return_map_counts)
+
+    if cache_dir is None:
+        catalog, weights, map_counts = extract_pattern_array(maps, N, return_map_counts=True)
+        tile_adj = compute_tile_adjacency(maps) if use_tile_adj else None
+        adjacency = build_adjacency_rules(catalog, tile_adj)
+    else:
+        catalog, weights, adjacency, map_counts = compile_incremental(maps, N, use_tile_adj, cache_dir)
+    if prune:
+        catalog, weights, adjacency, map_counts = prune_rules(catalog, weights, adjacency, map_counts)
+
+    if cache_dir is not None:
+        save_rules(cache_path, catalog, weights, adjacency, map_counts)
+    if return_map_counts:
+        return catalog, weights, adjacency, map_counts
+    return catalog, weights, adjacency
+
+
+def style_mix_vector(names, mix):
+    """
+    Turn a style mix into one factor per training map. mix is either a sequence with a factor for
+    every map (in load_all_maps order, i.e. sorted by file name) or a {name prefix: factor} dict such as
+    {"E1": 1, "E3": 0.5}, where each map takes the factor of the first prefix its name starts with and 0 otherwise.
+    names are the map names returned by load_all_maps(..., return_names=True).
+    """
+    if names is None:
+        raise ValueError("A style mix needs the training map names, see load_all_maps(..., return_names=True)")
+
+    if isinstance(mix, dict):
+        return np.array([next((f for prefix, f in mix.items() if name.startswith(prefix)), 0.0) for name in names])
+
+    mix = np.asarray(mix, dtype=float)
+    if len(mix) != len(names):
+        raise ValueError(f"Style mix has {len(mix)} factors for {len(names)} training maps")
+    return mix
+
+
+def style_weights(map_counts, mix):
+    """
+    Recompute pattern weights for a style mix with one sparse matrix-vector product:
+    weights = mix @ map_counts. Patterns that occur in none of the mixed maps keep a tiny
+    weight instead of 0, so the adjacency rules stay valid and they are only used when needed.
+    """
+    weights = np.asarray(map_counts.T @ np.asarray(mix, dtype=float)).ravel()
+    if not weights.any():
+        raise ValueError("Style mix gives every pattern a weight of 0")
+    return np.maximum(weights, weights.max() * 1e-6)
+
+
+def compile_incremental(maps, N, use_tile_adj, cache_dir):
+    """
+    Compile the unpruned catalog, weights, adjacency and per-map counts of the maps from cached
+    parts: only new or changed maps are scanned for patterns, and adjacency is only built for
+    patterns missing from the previous compile with the same tile adjacency. The result is
+    identical to a full rebuild; the unpruned rules are cached as the base of the next compile.
+    """
+    catalog, weights, map_counts, tile_adj = merge_map_summaries([cached_map_summary(m, N, cache_dir) for m in maps])
+    if not use_tile_adj:
+        tile_adj = None
+    print(f"Merged {len(maps)} maps into {len(catalog)} unique patterns")
+
+    # Rules of an earlier compile are only reusable if their tile adjacency filter was the same
+    tile_key = hashlib.sha256(f"v{RULES_CACHE_VERSION}|N={N}|".encode() + (
+        tile_adjacency_matrix(tile_adj).tobytes() if use_tile_adj else b"none")).hexdigest()[:16]
+    base_path = os.path.join(cache_dir, f"base_rules_N{N}_{tile_key}.npz")
+
+    if os.path.exists(base_path):
+        base_catalog, _, base_adjacency = load_rules(base_path)
+        if np.array_equal(base_catalog, catalog):
+            # Same patterns in the same order (only counts changed): the rules are unchanged too
+            return catalog, weights, base_adjacency, map_counts
+        adjacency = extend_adjacency_rules(catalog, tile_adj, base_catalog, base_adjacency)
+    else:
+        adjacency = build_adjacency_rules(catalog, tile_adj)
+
+    save_rules(base_path, catalog, weights, adjacency)
+    return catalog, weights, adjacency, map_counts
+
+
+def rules_cache_key(maps, N, use_tile_adj, prune=True):
+    """
+    Hash the content of the (sanitized) training maps together with the compile settings.
+    """
+    digest = hashlib.sha256(f"v{RULES_CACHE_VERSION}|N={N}|tile_adj={use_tile_adj}|prune={prune}".encode())
+    for map_data in maps:
+        for row in map_data:
+            digest.update("".join(row).encode() + b"\n")
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def save_rules(path, catalog, weights, adjacency, map_counts=None):
+    """
+    Save compiled rules to an .npz file: the (P, N, N) uint8 catalog, the weights,
+    the adjacency rules as CSR (indptr, indices) arrays per direction and,
+    if given, the sparse per-map pattern counts as CSR arrays.
+    """
+    print(f"Saving compiled rules to: {path}")
+
+    arrays = {'catalog': np.asarray(catalog), 'weights': np.asarray(weights, dtype=np.int64)}
+    for direction in range(4):
+        arrays[f'indptr_{direction}'] = adjacency.indptr[direction]
+        arrays[f'indices_{direction}'] = adjacency.indices[direction]
+    if map_counts is not None:
+        arrays['map_counts_data'] = map_counts.data
+        arrays['map_counts_indices'] = map_counts.indices
+        arrays['map_counts_indptr'] = map_counts.indptr
+        arrays['map_counts_shape'] = np.array(map_counts.shape)
+
+    # Write to a temporary file first so concurrent readers never see a partial cache
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_rules(path, return_map_counts=False):
+    """
+    Load compiled rules saved by save_rules and return the catalog, weights and adjacency,
+    and with return_map_counts the per-map pattern counts.
+    """
+    print(f"Loading compiled rules from: {path}")
+
+    with np.load(path) as data:
+        catalog = data['catalog']
+        weights = data['weights']
+        adjacency = AdjacencyRules(
+            [data[f'indptr_{d}'] for d in range(4)],
+            [data[f'indices_{d}'] for d in range(4)],
+            len(catalog)
+        )
+        if return_map_counts:
+            map_counts = sparse.csr_matrix(
+                (data['map_counts_data'], data['map_counts_indices'], data['map_counts_indptr']),
+                shape=tuple(data['map_counts_shape'])
+            )
+
+    print(f"Catalog contains {len(catalog)} unique patterns\n")
+    if return_map_counts:
+        return catalog, weights, adjacency, map_counts
+    return catalog, weights, adjacency
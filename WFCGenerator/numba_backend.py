@@ -0,0 +1,136 @@
+import numpy as np
+
+# Numba is optional: without it, BitsetWFC falls back to its NumPy propagation
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Offsets of the 4 cardinal directions (0=up, 1=right, 2=down, 3=left), as in WFC.DIRECTIONS
+DIRECTION_DX = np.array([0, 1, 0, -1])
+DIRECTION_DY = np.array([-1, 0, 1, 0])
+
+
+def compat_classes(compat):
+    """
+    Group the patterns of each direction by identical packed compatibility rows. Returns a
+    (4, P) array with the class of every pattern and a (4, C, words) array with the row of
+    every class (padded with empty rows), so the union of many rows is a union over few classes.
+    """
+    grouped = [np.unique(rows, axis=0, return_inverse=True) for rows in compat]
+    num_classes = max(len(rows) for rows, _ in grouped)
+
+    class_of = np.stack([classes.ravel() for _, classes in grouped])
+    class_rows = np.zeros((4, num_classes, compat.shape[2]), dtype=np.uint64)
+    for direction, (rows, _) in enumerate(grouped):
+        class_rows[direction, :len(rows)] = rows
+    return class_of, class_rows
+
+
+def propagate_bitset(wave, class_of, class_rows, starts_x, starts_y):
+    """
+    AC-3 propagation over a packed (H, W, words) bitset wave, starting from the given cells.
+    Visits cells and directions in exactly the order of WFCSolver.propagate_cells and removes
+    patterns from the wave in place. Returns the removals as a log of (x, y, removed words)
+    entries in order, and the number of cells visited.
+    """
+    height, width, words = wave.shape
+    num_patterns = class_of.shape[1]
+    num_classes = class_rows.shape[1]
+
+    # Growable removal log
+    capacity = 64
+    log_x = np.empty(capacity, dtype=np.int64)
+    log_y = np.empty(capacity, dtype=np.int64)
+    log_words = np.empty((capacity, words), dtype=np.uint64)
+    size = 0
+
+    stack_x = np.empty(max(16, len(starts_x)), dtype=np.int64)
+    stack_y = np.empty(max(16, len(starts_x)), dtype=np.int64)
+    stack_x[:len(starts_x)] = starts_x
+    stack_y[:len(starts_y)] = starts_y
+    depth = len(starts_x)
+
+    domain = np.empty(num_patterns, dtype=np.int64)
+    present = np.empty(num_classes, dtype=np.bool_)
+    possible = np.empty(words, dtype=np.uint64)
+    removed = np.empty(words, dtype=np.uint64)
+    contradiction = False
+    visited = 0
+
+    while depth > 0 and not contradiction:
+        depth -= 1
+        visited += 1
+        cx = stack_x[depth]
+        cy = stack_y[depth]
+
+        # Remaining patterns of the cell, read once before visiting its neighbors
+        count = 0
+        for w in range(words):
+            bits = wave[cy, cx, w]
+            for bit in range(64):
+                if bits & (np.uint64(1) << np.uint64(bit)):
+                    domain[count] = 64 * w + bit
+                    count += 1
+
+        for direction in range(4):
+            nx = cx + DIRECTION_DX[direction]
+            ny = cy + DIRECTION_DY[direction]
+            if nx < 0 or nx >= width or ny < 0 or ny >= height:
+                continue
+
+            # Union of the compatibility rows of all remaining patterns, taken once per class
+            present[:] = False
+            for k in range(count):
+                present[class_of[direction, domain[k]]] = True
+            possible[:] = 0
+            for c in range(num_classes):
+                if present[c]:
+                    for w in range(words):
+                        possible[w] |= class_rows[direction, c, w]
+
+            any_removed = False
+            any_left = False
+            for w in range(words):
+                removed[w] = wave[ny, nx, w] & ~possible[w]
+                if removed[w]:
+                    any_removed = True
+                    wave[ny, nx, w] &= possible[w]
+                if wave[ny, nx, w]:
+                    any_left = True
+
+            if any_removed:
+                if size == capacity:
+                    capacity *= 2
+                    grown_x = np.empty(capacity, dtype=np.int64)
+                    grown_y = np.empty(capacity, dtype=np.int64)
+                    grown_words = np.empty((capacity, words), dtype=np.uint64)
+                    grown_x[:size] = log_x
+                    grown_y[:size] = log_y
+                    grown_words[:size] = log_words
+                    log_x, log_y, log_words = grown_x, grown_y, grown_words
+                log_x[size] = nx
+                log_y[size] = ny
+                log_words[size] = removed
+                size += 1
+
+                if not any_left:
+                    contradiction = True
+
+                if depth == len(stack_x):
+                    grown_x = np.empty(2 * depth, dtype=np.int64)
+                    grown_y = np.empty(2 * depth, dtype=np.int64)
+                    grown_x[:depth] = stack_x
+                    grown_y[:depth] = stack_y
+                    stack_x, stack_y = grown_x, grown_y
+                stack_x[depth] = nx
+                stack_y[depth] = ny
+                depth += 1
+
+    return log_x[:size], log_y[:size], log_words[:size], visited
+
+
+# No on-disk cache: the module is imported both as numba_backend (script mode) and as
+# WFCGenerator.numba_backend (package mode), and a cache written under one name breaks the other
+if njit is not None:
+    propagate_bitset = njit(propagate_bitset)
@@ -1,4 +1,4 @@
-from WFCGenerator.WFCGenerator import call_wfc
+from WFCGenerator.WFCGenerator import generate_batch
 from txt2wad.txt2wad import main as call_txt2wad
 from evaluation.metrics import call_metrics
 import os
@@ -36,10 +36,11 @@ if __name__ == "__main__":
 
     # # Generating new maps for testing
     # os.makedirs("WFCGenerator/playtest", exist_ok=True)
+    # generate_batch(n_maps, (120, 120), N=3, seed=0, training_map_path=training_maps_folder,
+    #                save_dir=generated_txt_map_folder, prefix="generated_map_test")  # standard = (30,30)
     for i in range(n_maps):
         generated_txt_map_path = f"WFCGenerator/generated_maps/generated_map_test_{i}.txt"
         generated_wad_map_path = f"WFCGenerator/playtest/generated_map_test_{i}.wad"
-        # call_wfc(training_map_path=training_maps_folder, save_path=generated_txt_map_path, N=3, map_size=(120, 120))  # standard = (30,30)
         txt2wad(input=generated_txt_map_path, output=generated_wad_map_path)
 
     call_metrics(generated_maps_folder=generated_txt_map_folder, original_maps_folder=original_txt_map_folder)
\ No newline at end of file